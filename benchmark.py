@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+#
+# Measures how the obfuscation pipeline scales with the size of its input.
+#
+# Synthetic modules are built by repeating a procedure template with unique
+# names, so that every size carries the same mix of strings, comments,
+# identifiers, arrays and line continuations. The 'passes' benchmark profiles every
+# pass of the pipeline over a generated corpus with controlled counts of each
+# construct, and can be checked against results of an earlier run.
+#
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+import obfuscate
+
+
+PROCEDURE_TEMPLATE = '''
+' Procedure number %(num)d
+Sub Procedure%(num)d(ByVal argument%(num)d As String)
+    Dim variable%(num)d As String
+    Dim counter%(num)d, another%(num)d
+    variable%(num)d = "Some string literal number %(num)d"
+    another%(num)d = "short"
+    counter%(num)d = Array(1, 2, 3, %(num)d, 5, 6)   ' inline comment
+    Query%(num)d = "SELECT * FROM Table%(num)d WHERE Name = 'it''s' " _
+    & "AND Value >= 200 AND " _
+    & "Other < 320"
+    If counter%(num)d(0) <> 1 Then
+        MsgBox ("Result: " & variable%(num)d & another%(num)d)
+    End If
+End Sub
+'''
+
+# Constructs per generated procedure.
+CORPUS_COUNTS = {
+    'identifiers' : 4,
+    'strings' : 4,
+    'continuations' : 1,
+    'arrays' : 1,
+    'comments' : 2,
+}
+
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet')
+
+
+def generateModule(procedures):
+    return 'Dim GlobalVariable As String\n' + \
+        ''.join(PROCEDURE_TEMPLATE % {'num' : i} for i in range(procedures))
+
+
+def generateProcedure(num, counts, rng):
+    names = ['name%d_%d' % (num, i) for i in range(max(counts['identifiers'], 1))]
+    lines = ["' Comment %d of procedure %d" % (i, num) for i in range(counts['comments'] // 2)]
+    lines.append('Sub Procedure%d(ByVal argument%d As String)' % (num, num))
+
+    for name in names:
+        lines.append('    Dim %s As String' % name)
+
+    for i in range(counts['strings']):
+        literal = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 8)))
+        lines.append('    %s = "%s %d"' % (names[i % len(names)], literal, i))
+
+    for i in range(counts['continuations']):
+        lines.append('    Query%d_%d = "SELECT * FROM Table%d WHERE Name = \'%s\' " _' % (num, i, num, rng.choice(WORDS)))
+        lines.append('    & "AND Value >= %d AND " _' % rng.randint(0, 1000))
+        lines.append('    & "Other < %d"' % rng.randint(0, 1000))
+
+    for i in range(counts['arrays']):
+        values = ', '.join(str(rng.randint(0, 255)) for _ in range(rng.randint(4, 16)))
+        lines.append('    values%d_%d = Array(%s)' % (num, i, values))
+
+    for i in range(counts['comments'] - counts['comments'] // 2):
+        lines.append("    %s = %s & argument%d   ' inline comment %d" % (names[0], names[-1], num, i))
+
+    lines.append('    MsgBox (%s)' % ' & '.join(names))
+    lines.append('End Sub')
+    return '\n'.join(lines) + '\n'
+
+
+def generateCorpus(size, counts = CORPUS_COUNTS, seed = 0):
+    # Procedures get appended until the module is at least size bytes long.
+    rng = random.Random(seed)
+    parts = ['Dim GlobalVariable As String\n']
+    length = len(parts[0])
+    num = 0
+    while length < size:
+        procedure = generateProcedure(num, counts, rng)
+        parts.append(procedure)
+        length += len(procedure)
+        num += 1
+    return ''.join(parts)
+
+
+def runPasses(txt, seed, passes = None):
+    # Returns the per-pass records of a profiled obfuscation of txt.
+    profiler = obfuscate.PassProfiler()
+    obfuscator = obfuscate.ScriptObfuscator(garbage_perc = 0.0, seed = seed, profiler = profiler, passes = passes)
+    obfuscator.obfuscate(txt)
+    return profiler.report()['passes']
+
+
+def timeObfuscation(txt, repeat = 1, seed = 0, passes = None):
+    best = None
+    for _ in range(repeat):
+        obfuscator = obfuscate.ScriptObfuscator(garbage_perc = 0.0, seed = seed, passes = passes)
+        start = time.perf_counter()
+        obfuscator.obfuscate(txt)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmarkPipeline(sizes, repeat, seed, options):
+    print('%12s %10s %12s %12s' % ('procedures', 'size [KB]', 'time [s]', 'us / KB'))
+    results = []
+
+    for procedures in sizes:
+        txt = generateModule(procedures)
+        elapsed = timeObfuscation(txt, repeat, seed, options['passes'])
+        kb = len(txt) / 1024.0
+        print('%12d %10.1f %12.4f %12.1f' % (procedures, kb, elapsed, elapsed * 1e6 / kb))
+        results.append({'size' : procedures, 'bytes' : len(txt), 'time' : elapsed})
+
+    return results
+
+
+def benchmarkSubstitute(sizes, repeat, seed, options):
+    # obfuscateStringBySubstitute() on its own, for literals of growing length.
+    obfuscator = obfuscate.ScriptObfuscator(seed = seed)
+    print('%12s %12s %12s' % ('literal [B]', 'time [s]', 'ns / char'))
+    results = []
+
+    for size in sizes:
+        literal = ''.join(random.choice('abcdef "0123456789') for _ in range(size))
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            obfuscator.obfuscateStringBySubstitute(literal)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print('%12d %12.4f %12.1f' % (size, best, best * 1e9 / size))
+        results.append({'size' : size, 'bytes' : size, 'time' : best})
+
+    return results
+
+
+def benchmarkArrays(sizes, repeat, seed, options):
+    # obfuscateArrays() on its own, for numeric arrays of growing element counts.
+    rng = random.Random(seed)
+    print('%12s %12s %12s %14s' % ('elements', 'time [s]', 'ns / element', 'elements / s'))
+    results = []
+
+    for size in sizes:
+        txt = 'values = Array(%s)\n' % ', '.join(str(rng.randint(-255, 255)) for _ in range(size))
+        tokens = obfuscate.ScriptLexer.tokenize(txt)
+        best = None
+        for _ in range(repeat):
+            obfuscator = obfuscate.ScriptObfuscator(seed = seed)
+            obfuscator.tokens = list(tokens)
+            start = time.perf_counter()
+            obfuscator.obfuscateArrays()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print('%12d %12.4f %12.1f %14.0f' % (size, best, best * 1e9 / size, size / best))
+        results.append({'size' : size, 'bytes' : len(txt), 'time' : best})
+
+    return results
+
+
+def benchmarkNames(sizes, repeat, seed, options):
+    # NameAllocator on its own, for growing numbers of names of 4 to 12 characters.
+    print('%12s %12s %12s %14s %12s' % ('names', 'time [s]', 'ns / name', 'names / s', 'collisions'))
+    results = []
+
+    for size in sizes:
+        best = None
+        for _ in range(repeat):
+            allocator = obfuscate.NameAllocator(seed)
+            start = time.perf_counter()
+            names = allocator.allocateMany(size)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        if len(set(x.lower() for x in names)) != size:
+            raise AssertionError('duplicate names allocated')
+        print('%12d %12.4f %12.1f %14.0f %12d' % (size, best, best * 1e9 / size, size / best, allocator.collisions))
+        results.append({'size' : size, 'bytes' : size, 'time' : best, 'collisions' : allocator.collisions})
+
+    return results
+
+
+def benchmarkPasses(sizes, repeat, seed, options):
+    # Every pass timed on its own (best of repeat runs), peak memory of every pass
+    # taken from one more run under tracemalloc.
+    results = []
+
+    for kb in sizes:
+        txt = generateCorpus(kb * 1024, options['counts'], seed)
+        names = []
+        times = {}
+        for _ in range(repeat):
+            for record in runPasses(txt, seed, options['passes']):
+                name = record['pass']
+                if name not in times:
+                    names.append(name)
+                if name not in times or record['time'] < times[name]:
+                    times[name] = record['time']
+
+        peaks = dict.fromkeys(names, 0)
+        if options['memory']:
+            tracemalloc.start()
+            peaks = dict((x['pass'], x['peak_memory']) for x in runPasses(txt, seed, options['passes']))
+            tracemalloc.stop()
+
+        # Fused stages have longer names than single passes.
+        width = max([32] + [len(x) for x in names])
+        print('\nsize: %d KB (%d bytes)' % (kb, len(txt)))
+        print('%*s %12s %12s %14s' % (width, 'pass', 'time [s]', 'us / KB', 'peak mem [KB]'))
+        for name in names:
+            print('%*s %12.4f %12.1f %14.1f' % (width, name, times[name], times[name] * 1e6 * 1024 / len(txt), peaks[name] / 1024.0))
+        print('%*s %12.4f' % (width, 'total', sum(times.values())))
+
+        results.append({
+            'size' : kb,
+            'bytes' : len(txt),
+            'time' : sum(times.values()),
+            'passes' : dict((name, {'time' : times[name], 'peak_memory' : peaks[name]}) for name in names),
+        })
+
+    return results
+
+
+def scalingExponents(results):
+    # Least squares slope of log(time) over log(bytes) for every pass: 1.0 means
+    # linear scaling, 2.0 quadratic. Needs at least two sizes.
+    if len(results) < 2:
+        return {}
+
+    def slope(points):
+        points = [(math.log(x), math.log(max(y, 1e-9))) for (x, y) in points]
+        mx = sum(x for (x, y) in points) / len(points)
+        my = sum(y for (x, y) in points) / len(points)
+        den = sum((x - mx) ** 2 for (x, y) in points)
+        return sum((x - mx) * (y - my) for (x, y) in points) / den if den else 0.0
+
+    exponents = {'total' : slope([(r['bytes'], r['time']) for r in results])}
+    for name in results[0].get('passes', {}):
+        exponents[name] = slope([(r['bytes'], r['passes'][name]['time']) for r in results])
+    return exponents
+
+
+def compareWithBaseline(report, baseline, tolerance, exponentTolerance, minTime):
+    # Returns the list of regressions of report against the baseline report.
+    regressions = []
+
+    for (name, exponent) in report['exponents'].items():
+        expected = baseline.get('exponents', {}).get(name)
+        if expected is not None and exponent > expected + exponentTolerance:
+            regressions.append('%s: scales as n^%.2f, baseline n^%.2f' % (name, exponent, expected))
+
+    baselineResults = dict((r['size'], r) for r in baseline.get('results', []))
+    for result in report['results']:
+        old = baselineResults.get(result['size'])
+        if not old: continue
+
+        timings = [('total', result['time'], old['time'])]
+        for (name, measured) in result.get('passes', {}).items():
+            if name in old.get('passes', {}):
+                timings.append((name, measured['time'], old['passes'][name]['time']))
+
+        for (name, now, before) in timings:
+            if now >= minTime and now > before * (1.0 + tolerance):
+                regressions.append('%s at size %d: %.4fs, baseline %.4fs (+%.0f%%)' % \
+                    (name, result['size'], now, before, (now / before - 1.0) * 100.0))
+
+    return regressions
+
+
+BENCHMARKS = {
+    'pipeline' : (benchmarkPipeline, '50,100,200,400,800'),
+    'substitute' : (benchmarkSubstitute, '10,100,1000,10000,100000,1000000'),
+    'arrays' : (benchmarkArrays, '100,1000,10000,100000'),
+    'names' : (benchmarkNames, '1000,10000,100000,1000000'),
+    'passes' : (benchmarkPasses, '1,10,100,1000'),
+}
+
+
+def parseCounts(spec):
+    counts = dict(CORPUS_COUNTS)
+    for item in filter(None, spec.split(',')):
+        (name, value) = item.split('=')
+        if name not in counts:
+            raise argparse.ArgumentTypeError('unknown construct: %s' % name)
+        counts[name] = int(value)
+    return counts
+
+
+def parse_options(argv):
+    parser = argparse.ArgumentParser(
+        prog = 'benchmark.py',
+        description = 'Benchmarks obfuscate.py against synthetic Visual Basic modules.')
+
+    parser.add_argument("benchmark", nargs='?', choices=sorted(BENCHMARKS.keys()), default='pipeline', help="Benchmark to run: whole pipeline over generated modules (sizes in procedures), string substitution alone (sizes in bytes), numeric array rewriting alone (sizes in elements), name allocation alone (sizes in names), or every pass separately over a generated corpus (sizes in kilobytes). Default: pipeline")
+    parser.add_argument("-s", "--sizes", help="Comma-separated input sizes. Default depends on the benchmark.", default='')
+    parser.add_argument("-n", "--repeat", help="Take the best time out of that many runs. Default: 3", default=3, type=int)
+    parser.add_argument("--seed", help="Random seed. Default: 0", default=0, type=int)
+    parser.add_argument("-c", "--counts", help="Passes benchmark: constructs per generated procedure, e.g. 'strings=8,arrays=0'. Known: %s." % ', '.join('%s=%d' % x for x in sorted(CORPUS_COUNTS.items())), default=CORPUS_COUNTS, type=parseCounts)
+    parser.add_argument("--no-memory", dest="memory", help="Passes benchmark: skip the tracemalloc run measuring peak memory.", action='store_false')
+    parser.add_argument("-p", "--passes", help="Pipeline and passes benchmarks: comma-separated passes to run, as with obfuscate.py --passes. Default: all.", default=None, type=lambda x: obfuscate.ScriptObfuscator.passNames(filter(None, x.split(','))))
+    parser.add_argument("-o", "--output", help="Write results as JSON to that file.", default='')
+    parser.add_argument("-b", "--baseline", help="JSON results of an earlier run to compare with. Exits with 1 on regressions.", default='')
+    parser.add_argument("-t", "--tolerance", help="Allowed wall time increase over the baseline, as a fraction. Default: 0.5", default=0.5, type=float)
+    parser.add_argument("-e", "--exponent-tolerance", dest="exponent_tolerance", help="Allowed increase of the scaling exponent over the baseline. Default: 0.3", default=0.3, type=float)
+    parser.add_argument("--min-time", dest="min_time", help="Timings below that many seconds are too noisy to be compared. Default: 0.01", default=0.01, type=float)
+
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_options(argv)
+    random.seed(args.seed)
+
+    obfuscate.config['quiet'] = True
+    (benchmark, defaultSizes) = BENCHMARKS[args.benchmark]
+    sizes = [int(x) for x in (args.sizes or defaultSizes).split(',')]
+    pipeline = ['+'.join(p.name for p in stage) for stage in obfuscate.ScriptObfuscator(passes = args.passes).pipeline()]
+    print('pipeline: %s\n' % ' -> '.join(pipeline))
+    results = benchmark(sizes, args.repeat, args.seed, vars(args))
+
+    report = {
+        'benchmark' : args.benchmark,
+        'version' : obfuscate.VERSION,
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'numpy' : obfuscate.numpy is not None,
+        'seed' : args.seed,
+        'repeat' : args.repeat,
+        'counts' : args.counts,
+        'pipeline' : pipeline,
+        'results' : results,
+        'exponents' : scalingExponents(results),
+    }
+
+    if report['exponents']:
+        print('\nscaling exponents (time ~ n^k):')
+        width = max([32] + [len(x) for x in report['exponents']])
+        for (name, exponent) in report['exponents'].items():
+            print('%*s %8.2f' % (width, name, exponent))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('benchmark') != args.benchmark:
+            print('\nbaseline is of another benchmark: %s' % baseline.get('benchmark'))
+            return 1
+
+        regressions = compareWithBaseline(report, baseline, args.tolerance, args.exponent_tolerance, args.min_time)
+        if regressions:
+            print('\nregressions against %s:' % args.baseline)
+            for regression in regressions:
+                print('    ' + regression)
+            return 1
+        print('\nno regressions against %s' % args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
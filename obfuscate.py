@@ -2,22 +2,45 @@
 
 import re
 import os
+import io
 import sys
+import glob
+import json
+import hashlib
+import tempfile
+import contextlib
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import time
 import base64
-import struct
-import ctypes
+import bisect
+import array
 import string
 import random
+import stat
 import argparse
+import threading
+import collections
+import socketserver
+import http.server
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 VERSION='0.2'
 
-DEBUG = False
 SPLIT = 80      # split long lines at this column
 MAX_LINE_LENGTH = 1024 - 100
+LARGE_LITERAL_CHUNK = SPLIT * 8     # literals longer than MAX_LINE_LENGTH get encoded in pieces of that size
 
 config = {
     'verbose' : False,
+    'debug' : False,
     'quiet' : False,
     'file' : '',
     'output' : '',
@@ -25,9 +48,38 @@ config = {
     'min_var_length' : 5,
     'custom_reserved_words': [],
     'normalize_only': False,
-    'colors': True
+    'colors': True,
+    'inputs': [],
+    'manifest': '',
+    'output_dir': '',
+    'jobs': 0,
+    'summary': '',
+    'seed': None,
+    'cache': '',
+    'cache_size': 256,
+    'cache_stats': False,
+    'profile': False,
+    'cprofile': False,
+    'passes': None,
+    'serve': '',
+    'queue_size': 64,
 }
 
+# Batch inputs given as directories get searched for files with these extensions.
+INPUT_EXTENSIONS = ('.vb', '.vbs', '.vba', '.bas', '.cls', '.frm', '.hta', '.htm', '.html')
+
+# Where the log goes, how much of it and whether colored, per thread: the command
+# line sets these up for the whole process in config, logTo() overrides them for
+# the code run within it (batch files, procedure segments, library calls).
+logContext = threading.local()
+
+# Log levels: quiet writes nothing, normal only results and errors, verbose adds
+# info() and debug dbg() messages.
+LOG_QUIET = 0
+LOG_NORMAL = 1
+LOG_VERBOSE = 2
+LOG_DEBUG = 3
+
 class bcolors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -39,34 +91,70 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 def out(x, col = ''):
-    if not config['quiet']:
-        if col:
-            if config['colors']: sys.stderr.write(col + x + bcolors.ENDC + '\n')
-            else: sys.stderr.write(col + x + '\n')
-        else:
-            if config['colors']: sys.stderr.write(x + bcolors.ENDC + '\n')
-            else: sys.stderr.write(x + '\n')
+    if logLevel() > LOG_QUIET:
+        stream = logSink()
+        if logColors(): stream.write(col + x + bcolors.ENDC + '\n')
+        else: stream.write(x + '\n')
+
+def logSink():
+    return getattr(logContext, 'sink', None) or sys.stderr
+
+def logColors():
+    colors = getattr(logContext, 'colors', None)
+    return config['colors'] if colors is None else colors
+
+def optionsLogLevel(options):
+    if options['quiet']: return LOG_QUIET
+    if not options['verbose']: return LOG_NORMAL
+    return LOG_DEBUG if options['debug'] else LOG_VERBOSE
+
+def logLevel():
+    level = getattr(logContext, 'level', None)
+    return optionsLogLevel(config) if level is None else level
+
+def logEnabled(level):
+    # Loops logging per item check this once up front, rather than calling into
+    # info() or dbg() with their arguments for nothing.
+    return logLevel() >= level
+
+@contextlib.contextmanager
+def logTo(stream, level = None, colors = None):
+    # Level and colors are those of the enclosing context unless given.
+    previous = tuple(getattr(logContext, x, None) for x in ('sink', 'level', 'colors'))
+    logContext.sink = stream
+    if level is not None: logContext.level = level
+    if colors is not None: logContext.colors = colors
+    try:
+        yield stream
+    finally:
+        (logContext.sink, logContext.level, logContext.colors) = previous
+
+def writeLogs(logs):
+    # Logs captured by workers, passed on in order to the current sink.
+    stream = logSink()
+    for log in logs:
+        if log: stream.write(log)
 
 def log(x, col = ''):
-    if config['verbose']:
+    if logLevel() >= LOG_VERBOSE:
         out(x)
 
 def err(x, col = ''):
-    col2 = bcolors.BOLD + bcolors.FAIL if (config['colors'] and not col) else col
-    out(col2 + '[!] ' + x)
+    col2 = bcolors.BOLD + bcolors.FAIL if not col else col
+    out('[!] ' + x, col2)
 
-def dbg(x, col = ''):
-    if DEBUG:
-        col2 = bcolors.HEADER if (config['colors'] and not col) else col
-        log(col2 + "[DBG] " + x)
+# dbg() and info() format their message with args only when it is going to be written.
+def dbg(x, *args):
+    if logLevel() >= LOG_DEBUG:
+        out("[DBG] " + (x % args if args else x), bcolors.HEADER)
 
-def info(x, col = ''):
-    col2 = bcolors.OKBLUE if (config['colors'] and not col) else col
-    log(col2 + '[?] ' + x)
+def info(x, *args):
+    if logLevel() >= LOG_VERBOSE:
+        out('[?] ' + (x % args if args else x), bcolors.OKBLUE)
 
 def ok(x, col = ''):
-    col2 = bcolors.BOLD + bcolors.OKGREEN if (config['colors'] and not col) else col
-    out(col2 + '[+] ' + x)
+    col2 = bcolors.BOLD + bcolors.OKGREEN if not col else col
+    out('[+] ' + x, col2)
 
 
 class BitShuffleStringObfuscator:
@@ -84,10 +172,14 @@ class BitShuffleStringObfuscator:
 
     DEOBFUSCATE_ROUTINE_NAME = 'MacroStringDeobfuscate'
 
-    def __init__(self, obfuscateChar = None, obfuscateNumber = None):
+    def __init__(self, obfuscateChar = None, obfuscateNumber = None, seed = None):
         self.obfuscateChar = obfuscateChar
         self.obfuscateNum = obfuscateNumber
 
+        # The shuffle itself is deterministic, the generator is there for the
+        # char and number encoders to share with their owner.
+        self.random = makeRandom(seed)
+
         if not obfuscateChar:
             self.obfuscateChar = BitShuffleStringObfuscator.obfuscateCharWrapper
 
@@ -114,74 +206,105 @@ class BitShuffleStringObfuscator:
         d = (num & 0x000000ff)
         return (a,b,c,d)
 
-    def obfuscateString(self, string, addDeobfName = True):
-        chars = list(string)
-        obfuscated = b''
-
-        # Add null-byte padding for strings of length not divisible by 4
-        if len(chars) % 4 != 0:
-            chars.extend([BitShuffleStringObfuscator.STRING_PADDING_CHAR] * (4 - (len(chars) % 4)))
-
-        for i in range(int(len(chars) / 4) + 1):
-            fr = i * 4
-            to = fr + 4
-            if fr > len(chars) or to > len(chars): break
-            dword0 = chars[fr:to][:]
-            dword0.reverse()
-            dword = BitShuffleStringObfuscator.composeDword(*dword0)
-            obfuscatedDword = self.uintObfuscate(dword)
-            obfuscated += struct.pack('<I', obfuscatedDword)
-
-        if addDeobfName:
-            return BitShuffleStringObfuscator.DEOBFUSCATE_ROUTINE_NAME + \
-                '("%s")' % base64.b64encode(obfuscated).decode()
-        else:
-            return base64.b64encode(obfuscated).decode()
+    @staticmethod
+    def packDwords(string):
+        # Pads the string and packs it into little-endian dwords, one per four characters.
+        chars = string + BitShuffleStringObfuscator.STRING_PADDING_CHAR * (-len(string) % 4)
+        try:
+            dwords = array.array('I', chars.encode('latin-1'))
+            if sys.byteorder == 'big':
+                dwords.byteswap()
+        except UnicodeEncodeError:
+            # Wider characters get folded into their neighbours just like composeDword() does.
+            dwords = array.array('I', (
+                BitShuffleStringObfuscator.composeDword(chars[i+3], chars[i+2], chars[i+1], chars[i]) & 0xffffffff \
+                for i in range(0, len(chars), 4)
+            ))
+        return dwords
 
-    def deobfuscateString(self, string):
-        raw = list(base64.b64decode(string))
-        out = ''
-
-        for i in range(len(raw) / 4 + 1):
-            fr = i * 4
-            to = fr + 4
-            if fr > len(raw) or to > len(raw): break
-            dword0 = raw[fr:to][:]
-            dword0.reverse()
-            dword = BitShuffleStringObfuscator.composeDword(*dword0)
-            rawDword = self.uintRestore(dword)
-            out += struct.pack('<I', rawDword)
-
-        # Remove null-byte padding
-        while out.endswith(BitShuffleStringObfuscator.STRING_PADDING_CHAR):
-            out = out[:-1]
-        
-        return out
+    @staticmethod
+    def unpackDwords(dwords):
+        if sys.byteorder == 'big':
+            dwords = array.array('I', dwords)
+            dwords.byteswap()
+        return dwords.tobytes()
 
-    def uintObfuscate(self, num):
+    def shuffleDwords(self, dwords, restore = False):
         mask1 = self.OBFUSCATION_PARAMS['mask1']
         mask2 = self.OBFUSCATION_PARAMS['mask2']
         d1 = self.OBFUSCATION_PARAMS['d1']
         d2 = self.OBFUSCATION_PARAMS['d2']
 
-        t = ctypes.c_uint((num ^ (num >> d1)) & mask1).value
-        u = ctypes.c_uint((num ^ t ^ (t << d1))).value
-        t = ctypes.c_uint((u ^ (u >> d2)) & mask2).value
-        out = ctypes.c_uint(u ^ t ^ (t << d2)).value
+        if restore:
+            (mask1, mask2, d1, d2) = (mask2, mask1, d2, d1)
+
+        if numpy is not None and len(dwords) > 0:
+            x = numpy.frombuffer(dwords, dtype=numpy.uint32)
+            t = (x ^ (x >> d1)) & mask1
+            u = x ^ t ^ (t << d1)
+            t = (u ^ (u >> d2)) & mask2
+            return array.array('I', (u ^ t ^ (t << d2)).tobytes())
+
+        out = array.array('I', dwords)
+        for i in range(len(out)):
+            x = out[i]
+            t = (x ^ (x >> d1)) & mask1
+            u = (x ^ t ^ (t << d1)) & 0xffffffff
+            t = (u ^ (u >> d2)) & mask2
+            out[i] = (u ^ t ^ (t << d2)) & 0xffffffff
         return out
 
-    def uintRestore(self, num):
-        mask1 = self.OBFUSCATION_PARAMS['mask1']
-        mask2 = self.OBFUSCATION_PARAMS['mask2']
-        d1 = self.OBFUSCATION_PARAMS['d1']
-        d2 = self.OBFUSCATION_PARAMS['d2']
+    def obfuscateString(self, string, addDeobfName = True):
+        return self.obfuscateStrings([string], addDeobfName)[0]
+
+    def obfuscateStrings(self, strings, addDeobfName = True):
+        # Encodes many strings at once, shuffling the dwords of all of them in a single run.
+        dwords = array.array('I')
+        bounds = []
+        for string in strings:
+            start = len(dwords)
+            dwords.extend(BitShuffleStringObfuscator.packDwords(string))
+            bounds.append((start * 4, len(dwords) * 4))
+
+        raw = memoryview(BitShuffleStringObfuscator.unpackDwords(self.shuffleDwords(dwords)))
+        out = []
+        for (fr, to) in bounds:
+            encoded = base64.b64encode(raw[fr:to]).decode()
+            if addDeobfName:
+                encoded = BitShuffleStringObfuscator.DEOBFUSCATE_ROUTINE_NAME + '("%s")' % encoded
+            out.append(encoded)
+        return out
 
-        t = ctypes.c_uint((num ^ (num >> d2)) & mask2).value
-        u = ctypes.c_uint(num ^ t ^ (t << d2)).value
-        t = ctypes.c_uint((u ^ (u >> d1)) & mask1).value
-        out = ctypes.c_uint(u ^ t ^ (t << d1)).value
+    def deobfuscateString(self, string):
+        return self.deobfuscateStrings([string])[0]
+
+    def deobfuscateStrings(self, strings):
+        dwords = array.array('I')
+        bounds = []
+        for string in strings:
+            raw = base64.b64decode(string)
+            # Trailing bytes not forming a whole dword are ignored.
+            raw = raw[:len(raw) - len(raw) % 4]
+            start = len(dwords)
+            dwords.frombytes(raw)
+            bounds.append((start * 4, len(dwords) * 4))
+
+        if sys.byteorder == 'big':
+            dwords.byteswap()
+
+        raw = BitShuffleStringObfuscator.unpackDwords(self.shuffleDwords(dwords, restore = True))
+        out = []
+        for (fr, to) in bounds:
+            # Remove the padding
+            out.append(raw[fr:to].decode('latin-1').rstrip(BitShuffleStringObfuscator.STRING_PADDING_CHAR))
         return out
 
+    def uintObfuscate(self, num):
+        return self.shuffleDwords(array.array('I', [num & 0xffffffff]))[0]
+
+    def uintRestore(self, num):
+        return self.shuffleDwords(array.array('I', [num & 0xffffffff]), restore = True)[0]
+
     def getDeobfuscatorFuncName(self):
         return self.DEOBFUSCATE_ROUTINE_NAME
 
@@ -355,6 +478,423 @@ End Function
 }
 
 
+class ScriptLexer:
+
+    # Token kinds. A token is a (kind, text) tuple and joining the texts of
+    # a token stream gives back the exact text it was produced from.
+    NEWLINE = 0
+    WHITESPACE = 1
+    CONTINUATION = 2    # " _" ending a physical line
+    COMMENT = 3
+    STRING = 4
+    NUMBER = 5
+    IDENTIFIER = 6
+    OPERATOR = 7
+    CODE = 8            # code emitted by an obfuscation pass, opaque to the following ones
+
+    TOKENS_REGEX = r"""
+        (?P<newline>\r?\n)
+        |(?P<continuation>[ \t]+_[ \t]*(?=\r?\n|$))
+        |(?P<whitespace>[ \t]+)
+        |(?P<comment>'[^\r\n]*)
+        |(?P<string>"[^"\r\n]*(?:""[^"\r\n]*)*"?)
+        |(?P<number>&[Hh][0-9A-Fa-f]+&?(?!\w)|&[Oo][0-7]+&?(?!\w)|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?[%&!#@]?)
+        |(?P<identifier>[^\W\d]\w*)
+        |(?P<operator>[\s\S])
+    """
+
+    KINDS = {
+        'newline' : NEWLINE,
+        'continuation' : CONTINUATION,
+        'whitespace' : WHITESPACE,
+        'comment' : COMMENT,
+        'string' : STRING,
+        'number' : NUMBER,
+        'identifier' : IDENTIFIER,
+        'operator' : OPERATOR,
+    }
+
+    tokensRex = re.compile(TOKENS_REGEX, flags=re.X)
+
+    @staticmethod
+    def tokenize(txt):
+        kinds = ScriptLexer.KINDS
+        return [(kinds[m.lastgroup], m.group()) for m in ScriptLexer.tokensRex.finditer(txt)]
+
+    @staticmethod
+    def tokenizeSpans(spans):
+        # Tokens of text held in pieces (source, start, stop), as EditBuffer.spans()
+        # yields them. Pieces start and end at line boundaries, so no token ever
+        # spans two of them.
+        kinds = ScriptLexer.KINDS
+        tokens = []
+        for (source, start, stop) in spans:
+            tokens.extend([(kinds[m.lastgroup], m.group()) for m in ScriptLexer.tokensRex.finditer(source, start, stop)])
+        return tokens
+
+    @staticmethod
+    def join(tokens):
+        return ''.join([tok[1] for tok in tokens])
+
+    @staticmethod
+    def write(tokens, stream, chunk = 4096):
+        # Writes the text of the tokens out a chunk at a time, returning its length.
+        written = 0
+        for i in range(0, len(tokens), chunk):
+            text = ''.join([tok[1] for tok in tokens[i:i + chunk]])
+            stream.write(text)
+            written += len(text)
+        return written
+
+    @staticmethod
+    def lines(tokens):
+        # Yields physical lines as lists of tokens, each one ending with its NEWLINE token.
+        line = []
+        for tok in tokens:
+            line.append(tok)
+            if tok[0] == ScriptLexer.NEWLINE:
+                yield line
+                line = []
+        if line:
+            yield line
+
+    @staticmethod
+    def lineOffsets(tokens):
+        # Token index at which every physical line starts, followed by the stream
+        # length, so that line n spans tokens[offsets[n]:offsets[n + 1]].
+        offsets = [0]
+        for i in range(len(tokens)):
+            if tokens[i][0] == ScriptLexer.NEWLINE:
+                offsets.append(i + 1)
+        if offsets[-1] != len(tokens):
+            offsets.append(len(tokens))
+        return offsets
+
+    @staticmethod
+    def lineText(line):
+        return ScriptLexer.join(line).rstrip('\r\n')
+
+    @staticmethod
+    def elidedLineText(line):
+        # Contents of literals are left out, both to not match on them and to keep
+        # regex scans linear on lines carrying huge literals.
+        return ScriptLexer.lineText([(kind, '""' if kind == ScriptLexer.STRING else text) for (kind, text) in line])
+
+    @staticmethod
+    def isBlankLine(line):
+        for tok in line:
+            if tok[0] != ScriptLexer.WHITESPACE and tok[0] != ScriptLexer.NEWLINE:
+                return False
+        return True
+
+    @staticmethod
+    def isMemberAccess(tokens, i):
+        return i > 0 and tokens[i - 1] == (ScriptLexer.OPERATOR, '.')
+
+
+class EditBuffer:
+    # Piece table the text passes record their edits into, instead of building a
+    # new copy of the whole text each. Pieces refer either to a span of the
+    # original text or to the text an edit brought in, so the text only gets
+    # materialized (or written out) once all edits are done, and every offset
+    # maps back onto the original text it came from. The buffer only covers the
+    # text passes: once tokenized, token passes rewrite the token list and offsets
+    # of their output no longer map back onto the input.
+
+    __slots__ = ('original', 'pieces', 'starts')
+
+    def __init__(self, text):
+        self.original = text
+
+        # (start, stop, text): text is None for the [start, stop) span of the
+        # original, otherwise text brought in by an edit of that span.
+        self.pieces = [(0, len(text), None)] if text else []
+        self.starts = None
+
+    @staticmethod
+    def length(piece):
+        return piece[1] - piece[0] if piece[2] is None else len(piece[2])
+
+    @staticmethod
+    def cut(piece, i, j = None):
+        (start, stop, text) = piece
+        if text is None:
+            return (start + i, stop if j is None else start + j, None)
+        return (start, stop, text[i:j])
+
+    def __len__(self):
+        return sum(map(EditBuffer.length, self.pieces))
+
+    def spans(self):
+        for (start, stop, text) in self.pieces:
+            if text is None:
+                yield (self.original, start, stop)
+            else:
+                yield (text, 0, len(text))
+
+    def lines(self):
+        # Lines of the text the way str.split('\n') cuts it.
+        carry = ''
+        for (source, start, stop) in self.spans():
+            parts = source[start:stop].split('\n')
+            parts[0] = carry + parts[0]
+            carry = parts.pop()
+            for line in parts:
+                yield line
+        yield carry
+
+    def edit(self, edits):
+        # Applies edits (start, stop, text) replacing the [start, stop) span with
+        # text, given in offsets from before any of them, sorted and not
+        # overlapping, in one walk over the pieces.
+        pieces = []
+        source = iter(self.pieces)
+        piece = next(source, None)
+        pos = 0
+
+        for (start, stop, text) in edits:
+            while piece is not None and pos + EditBuffer.length(piece) <= start:
+                pieces.append(piece)
+                pos += EditBuffer.length(piece)
+                piece = next(source, None)
+            if piece is not None and pos < start:
+                pieces.append(EditBuffer.cut(piece, 0, start - pos))
+                piece = EditBuffer.cut(piece, start - pos)
+                pos = start
+            origin = piece[0] if piece is not None else len(self.original)
+
+            while piece is not None and pos + EditBuffer.length(piece) <= stop:
+                pos += EditBuffer.length(piece)
+                piece = next(source, None)
+            if piece is not None and pos < stop:
+                piece = EditBuffer.cut(piece, stop - pos)
+                pos = stop
+
+            if text:
+                pieces.append((origin, piece[0] if piece is not None else len(self.original), text))
+
+        if piece is not None:
+            pieces.append(piece)
+            pieces.extend(source)
+
+        self.pieces = pieces
+        self.starts = None
+
+    def originalOffset(self, pos):
+        # Offset of the original text the text at pos came from; text brought in by
+        # an edit maps onto the start of the span it replaced.
+        if self.starts is None:
+            self.starts = []
+            offset = 0
+            for piece in self.pieces:
+                self.starts.append(offset)
+                offset += EditBuffer.length(piece)
+
+        i = bisect.bisect_right(self.starts, pos) - 1
+        if i < 0:
+            return 0
+        (start, stop, text) = self.pieces[i]
+        if text is None:
+            return min(start + pos - self.starts[i], stop)
+        return start
+
+    def text(self):
+        if len(self.pieces) == 1 and self.pieces[0] == (0, len(self.original), None):
+            return self.original
+        return ''.join([source[start:stop] for (source, start, stop) in self.spans()])
+
+    def write(self, stream):
+        written = 0
+        for (source, start, stop) in self.spans():
+            stream.write(source[start:stop])
+            written += stop - start
+        return written
+
+
+class FunctionBoundary:
+
+    __slots__ = ('funcName', 'funcStart', 'funcStop')
+
+    def __init__(self, funcName, funcStart, funcStop = -1):
+        self.funcName = funcName
+        self.funcStart = funcStart
+        self.funcStop = funcStop
+
+
+class Pass:
+    # One step of the obfuscation pipeline, referring to methods of ScriptObfuscator
+    # by name. A pass consumes and produces either the text of the script or its
+    # token stream; conversions between the two are inserted by the pipeline where
+    # needed. Line-local passes rewrite one physical line at a time (line method
+    # returning the new line, or None to drop it, plus an optional finish method
+    # over the whole result), so that adjacent ones get fused into one traversal.
+
+    __slots__ = ('name', 'option', 'consumes', 'produces', 'run', 'line', 'finish', 'requires', 'help')
+
+    TEXT = 'text'
+    TOKENS = 'tokens'
+
+    def __init__(self, name, option, consumes, produces, run = None, line = None, finish = None, requires = (), help = ''):
+        self.name = name
+        self.option = option
+        self.consumes = consumes
+        self.produces = produces
+        self.run = run
+        self.line = line
+        self.finish = finish
+        self.requires = requires
+        self.help = help
+
+
+class PassProfiler:
+    # Records, for every pass of ScriptObfuscator.obfuscate(), its wall and CPU time,
+    # the size of the code before and after it and whatever the pass counted (regex
+    # matches, literals, names or arrays rewritten). Peak memory of every pass is
+    # recorded as well while tracemalloc is tracing. Optionally runs the whole
+    # obfuscation under cProfile too.
+
+    def __init__(self, cprofile = False):
+        self.passes = []
+        self.current = None
+        self.profile = cProfile.Profile() if cprofile else None
+
+    def begin(self):
+        if self.profile:
+            self.profile.enable()
+
+    def end(self):
+        if self.profile:
+            self.profile.disable()
+
+    def run(self, obfuscator, name, method, *args):
+        bytesIn = obfuscator.currentSize()
+        self.current = {'pass' : name, 'counts' : {}}
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            memoryBefore = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        cpuStart = time.process_time()
+        result = method(*args)
+        self.current['time'] = time.perf_counter() - start
+        self.current['cpu_time'] = time.process_time() - cpuStart
+
+        if tracing:
+            self.current['peak_memory'] = tracemalloc.get_traced_memory()[1] - memoryBefore
+
+        self.current['bytes_in'] = bytesIn
+        self.current['bytes_out'] = obfuscator.currentSize()
+        self.passes.append(self.current)
+        self.current = None
+        return result
+
+    def count(self, name, value):
+        if self.current is not None:
+            self.current['counts'][name] = self.current['counts'].get(name, 0) + value
+
+    def report(self):
+        return {
+            'passes' : self.passes,
+            'time' : sum(x['time'] for x in self.passes),
+            'cpu_time' : sum(x['cpu_time'] for x in self.passes),
+        }
+
+    def dumpStats(self, path):
+        self.profile.dump_stats(path)
+
+    def printStats(self, stream, limit = 30):
+        pstats.Stats(self.profile, stream = stream).sort_stats('cumulative').print_stats(limit)
+
+
+# Names no obfuscation may rename or generate, shipped next to this script.
+BUILTIN_RESERVED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vba-reserved.txt')
+
+def loadReservedWords(path):
+    # One name per line, lines starting with '#' being comments. Names get
+    # casefolded, Visual Basic comparing them case-insensitively.
+    with open(path, 'r') as f:
+        return frozenset(x.strip().casefold() for x in f if x.strip() and not x.lstrip().startswith('#'))
+
+@functools.lru_cache(maxsize = None)
+def builtinReservedWords():
+    # Visual Basic keywords, intrinsic functions and constants, read once when first
+    # needed.
+    try:
+        return loadReservedWords(BUILTIN_RESERVED_FILE)
+    except OSError as e:
+        err('Could not load built-in reserved words: %s' % e)
+        return frozenset()
+
+class NameAllocator:
+    # Hands out random identifiers that were neither handed out before nor are
+    # taken by a built-in or reserved word or a name present in the code, compared
+    # casefolded as Visual Basic compares them case-insensitively. Candidates get generated a batch at
+    # a time and checked against a set of the taken names. Obfuscators of the
+    # modules of one project may share an allocator, for names to be unique
+    # across all of them.
+
+    BATCH = 256
+
+    def __init__(self, seed = None, reserved = ()):
+        self.random = makeRandom(seed)
+        self.taken = set(builtinReservedWords())
+        self.taken.update(x.casefold() for x in reserved)
+        self.pending = {}
+        self.supplied = set()
+        self.allocated = 0
+        self.collisions = 0
+
+    def reserve(self, names):
+        self.taken.update(x.casefold() for x in names)
+
+    def supply(self, names, minLength = 4, maxLength = 12):
+        # Names allocated elsewhere (by the parent of a procedure worker), handed out
+        # before generating any.
+        self.reserve(names)
+        self.supplied.update(x.casefold() for x in names)
+        self.pending.setdefault((minLength, maxLength), []).extend(reversed(names))
+
+    def allocate(self, minLength = 4, maxLength = 12):
+        pending = self.pending.setdefault((minLength, maxLength), [])
+        collisions = 0
+        while True:
+            if collisions > NameAllocator.BATCH * 64:
+                raise ValueError('No names of %d to %d characters left to allocate' % (minLength, maxLength))
+            if not pending:
+                pending.extend(self.generate(NameAllocator.BATCH, minLength, maxLength))
+            name = pending.pop()
+            key = name.casefold()
+            if key in self.supplied:
+                self.supplied.discard(key)
+            elif key in self.taken:
+                self.collisions += 1
+                collisions += 1
+                continue
+            self.taken.add(key)
+            self.allocated += 1
+            return name
+
+    def allocateMany(self, count, minLength = 4, maxLength = 12):
+        return [self.allocate(minLength, maxLength) for x in range(count)]
+
+    def generate(self, count, minLength, maxLength):
+        # A letter, then letters and digits, lengths spread uniformly.
+        rand = self.random.random
+        span = maxLength - minLength + 1
+        lengths = [minLength + int(rand() * span) for x in range(count)]
+        firsts = self.random.choices(string.ascii_letters, k = count)
+        rest = ''.join(self.random.choices(string.ascii_letters + string.digits, k = sum(lengths) - count))
+
+        names = []
+        pos = 0
+        for (first, length) in zip(firsts, lengths):
+            names.append(first + rest[pos:pos + length - 1])
+            pos += length - 1
+        return names
+
+
 class ScriptObfuscator:
 
     RESERVED_NAMES = (
@@ -374,641 +914,1918 @@ class ScriptObfuscator:
         "Workbook_Close"
     )
 
-    COMMENT_REGEX = r"'((?!\").)*$"
-    STRINGS_REGEX = r"(\"(?:[^\"\n]|\"\")+\")"
+    # Lines starting with these continue a statement begun on an earlier line.
+    BRANCH_KEYWORDS = ('elseif', 'else', 'case')
 
-    FUNCTION_REGEX = r"(?:Public|Private|Protected|Friend)?\s*(?:Sub|Function)\s+(\w+)\s*\(.*\)"
+    # var = "value" _\n& "value" ; var = var + "value"
+    LONG_LINES_REGEX = r"^\s*(?:(?:(\w+)\s*=(\s*\1\s*\+)?)|&)\s*\"([^\"]+)\"(\s+_)?"
 
-    # var = "value" _\n& "value"
-    LONG_LINES_REGEX = r"^\s*(?:(?:(\w+)\s*=(?:\s*\1\s*\+)?)|&)\s*\"([^\"]+)\"(?:\s+_)?"
+    # Whitespace around these is dropped by removeLineIndents.
+    INDENT_OPERATORS = ('+', '-', '/', '*', '=', '\\', ',', '>', '<', '^')
 
-    # Dim var ; Dim Var As Type ; Set Var = [...]
-    VARIABLES_REGEX = r"^\s*(?:(?:\s*(\w+)\s*=(?!\"))|(?:Dim|Set|Const)\s+(\w+)\s*(?:As|=)?)|(?:^(\w+)\s+As\s+)"
+    # Encodings of a number given a random offset. Division by a zero offset
+    # leaves the number as it is.
+    NUMBER_CODERS = (
+        lambda rnd1, num: '%d' % num,
+        lambda rnd1, num: '%d-%d' % (rnd1+num, rnd1),
+        lambda rnd1, num: '%d-%d' % (2*rnd1+num, 2*rnd1),
+        lambda rnd1, num: '%d-%d' % (3*rnd1+num, 3*rnd1),
+        lambda rnd1, num: '%d+%d' % (-rnd1, rnd1+num),
+        lambda rnd1, num: '%d/%d' % (rnd1*num, rnd1) if rnd1 else '%d' % num,
+    )
+
+    # Encodings of a character: formatting the character itself (0), its code
+    # obfuscated as a number (3), or its code (all the others).
+    CHAR_CODERS = (
+        '"%s"',
+        'Chr(&H%x)',
+        'Chr(%d)',
+        'Chr(%s)',
+        'Chr(Int("&H%x"))',
+        'Chr(Int("%d"))',
+    )
 
-    # Dim Var1, var2, va3 As Type
-    VARIABLE_DECLARATIONS_REGEX = r"Dim\s+(?:(?:\s*,\s*)?(\w+)(?:\s*,\s*)?)+"
+    # Characters an Array(...) body may consist of to be tried as numbers.
+    NUMERIC_ARRAY_CHARS = frozenset(string.digits + 'abcdef -_&,')
 
     FUNCTION_PARAMETERS_REGEX = r"(?:(?:Optional\s+)?\s*(?:ByRef|ByVal\s+)?(\w+)\s+As\s+\w+\s*,?\s*)"
 
-    # Public Dim Var As Type ; Public Declare PtrSafe [...]
-    GLOBALS_REGEX = r"\s*(?:(?:Public|Private|Protected)\s*(?:Dim|Set|Const)?\s+(\w+)\s*As)"
+    # Runs of blank lines, each one along with its line break.
+    BLANK_LINES_REGEX = re.compile(r'^(?:[^\S\n]*\n)+', flags=re.M)
+
+    # Procedures are cut into about that many segments per worker process, so that
+    # a few long procedures do not leave the other workers idle.
+    SEGMENTS_PER_JOB = 4
+
+    # The pipeline, in the order passes run in.
+    PASSES = (
+        Pass('removeEmptyLines', 'empty-lines', Pass.TEXT, Pass.TEXT, run = 'removeEmptyLines', help = 'remove empty lines'),
+        Pass('mergeAndConcatLongLines', 'long-lines', Pass.TEXT, Pass.TEXT, run = 'mergeAndConcatLongLines', help = 'merge long string lines and split them again'),
+        Pass('obfuscateStrings', 'strings', Pass.TOKENS, Pass.TOKENS, run = 'obfuscateStrings', help = 'explode string constants'),
+        Pass('addDeobfuscator', 'deobfuscator', Pass.TOKENS, Pass.TOKENS, run = 'addDeobfuscator', requires = ('obfuscateStrings',), help = 'append the string deobfuscation routine'),
+        Pass('randomizeVariablesAndFunctions', 'names', Pass.TOKENS, Pass.TOKENS, run = 'randomizeVariablesAndFunctions', help = 'rename variables, parameters and functions'),
+        Pass('obfuscateArrays', 'arrays', Pass.TOKENS, Pass.TOKENS, run = 'obfuscateArrays', help = 'obfuscate numeric arrays'),
+        Pass('removeComments', 'comments', Pass.TOKENS, Pass.TOKENS, line = 'removeLineComment', help = 'remove comments'),
+        Pass('removeIndents', 'indents', Pass.TOKENS, Pass.TOKENS, line = 'removeLineIndents', help = 'remove indents and multi-spaces'),
+        Pass('removeEmptyTokenLines', 'blank-lines', Pass.TOKENS, Pass.TOKENS, line = 'removeEmptyTokenLine', finish = 'dropTrailingNewline', help = 'remove lines left blank'),
+    )
+
+    TOKENIZE = Pass('tokenize', 'tokenize', Pass.TEXT, Pass.TOKENS, run = 'tokenize')
+    JOIN = Pass('join', 'join', Pass.TOKENS, Pass.TEXT, run = 'join')
+    PARALLEL = Pass('obfuscateInParallel', 'parallel', Pass.TOKENS, Pass.TOKENS, run = 'obfuscateInParallel')
 
-    # Private Declare PtrSafe Function [...] Lib [...]
-    PTRSAFE_FUNCTIONS_REGEX = r'(?:Private|Protected|Public)?\s*Declare\s+(?:PtrSafe\s+)?(?:Sub|Function)\s+(?:\w+)\s+Lib\s*"[^"]+"\s*(?:Alias\s*"([^"]+)")?\s*'
+    NORMALIZE_PASSES = ('mergeAndConcatLongLines',)
 
+    # Passes the deobfuscation routines go through when added apart from the code.
+    DEOBFUSCATOR_PASSES = ('removeEmptyLines', 'randomizeVariablesAndFunctions', 'removeComments', 'removeIndents', 'removeEmptyTokenLines')
 
-    def __init__(self, normalize_only = False, reserved_words = [], garbage_perc = 12.0, min_var_length = 5):
+    def __init__(self, normalize_only = False, reserved_words = None, garbage_perc = 12.0, min_var_length = 5, jobs = 1, seed = None, profiler = None, passes = None, debug = False, names = None):
         self.input = ''
         self.output = ''
-
-        self.bitShuffleObfuscator = BitShuffleStringObfuscator(ScriptObfuscator.obfuscateChar, ScriptObfuscator.obfuscateNumber)
+        self.buffer = EditBuffer('')
+        self.stream = None
+        self.written = 0
+        self.tokens = []
+        self.renames = {}
+
+        # Every random choice is drawn from this generator, seed may be a random.Random
+        # instance to draw from or anything random.seed() accepts.
+        self.random = makeRandom(seed)
+        self.bitShuffleObfuscator = BitShuffleStringObfuscator(self.obfuscateChar, self.obfuscateNumber, self.random)
         self.function_boundaries = []
+        self.function_names = {}
         self.deobfuscatorAddedOnce = False
         self.avoidRemovingTheseComments = []
 
         self.normalize_only = normalize_only
         self.garbage_perc = garbage_perc
         self.min_var_length = min_var_length
-        self.reserved_words = reserved_words
+        self.jobs = jobs
+        self.profiler = profiler
 
-    def obfuscate(self, inp):
-        self.input = inp
-        self.output = inp
+        # Names never to be renamed: built-in ones, entry points and those given,
+        # casefolded into one set.
+        self.reserved_words = sorted(set(x.casefold() for x in reserved_words or ()))
+        self.reserved = builtinReservedWords().union(
+            (x.casefold() for x in ScriptObfuscator.RESERVED_NAMES), self.reserved_words)
 
-        # Normalization processes, avoid obfuscating.
-        if self.normalize_only:
-            self.output = self.mergeAndConcatLongLines(self.output)
-            return self.output
+        # New identifiers come from this allocator, which may be shared with the
+        # obfuscators of other modules of the same project.
+        self.names = names if names is not None else NameAllocator(self.random)
+        self.names.reserve(self.reserved)
 
-        # Remove empty lines
-        self.output = self.removeEmptyLines(self.output)
+        # Debug output keeps indents and spaces around concatenations, for the
+        # obfuscated code to be read more easily.
+        self.debug = debug
 
-        # Merge long string lines and split them to concatenate.
-        self.output = self.mergeAndConcatLongLines(self.output)
+        # Names of the passes to run, given either way Pass knows them by.
+        if normalize_only:
+            passes = ScriptObfuscator.NORMALIZE_PASSES
+        self.passes = ScriptObfuscator.passNames(passes)
 
-        # Explode string constants
-        self.obfuscateStrings()
+    @staticmethod
+    def passNames(passes = None):
+        if passes is None:
+            return [p.name for p in ScriptObfuscator.PASSES]
+
+        known = {}
+        for p in ScriptObfuscator.PASSES:
+            known[p.name.lower()] = p.name
+            known[p.option] = p.name
+
+        names = set()
+        for name in passes:
+            if name.lower() not in known:
+                raise ValueError('Unknown pass: %s' % name)
+            names.add(known[name.lower()])
+        return [p.name for p in ScriptObfuscator.PASSES if p.name in names]
+
+    def settings(self):
+        return {
+            'normalize_only' : self.normalize_only,
+            'reserved_words' : self.reserved_words,
+            'garbage_perc' : self.garbage_perc,
+            'min_var_length' : self.min_var_length,
+            'passes' : self.passes,
+            'debug' : self.debug,
+        }
+
+    def obfuscate(self, inp, stream = None):
+        # Returns the obfuscated code or, given a stream, writes it out there and
+        # returns its length. Text passes edit the buffer, token passes the token
+        # stream, and the code is only put together once all of them are done.
+        self.input = inp
+        self.output = ''
+        self.buffer = EditBuffer(inp)
+        self.stream = stream
+        self.written = 0
+        self.tokens = []
+        self.renames = {}
+
+        if self.profiler:
+            self.profiler.begin()
+        try:
+            return self.runPasses()
+        finally:
+            if self.profiler:
+                self.profiler.end()
+
+    def pipeline(self):
+        # Stages to run: every stage is a list of passes, more than one of them when
+        # adjacent line-local passes got fused. Passes missing what they require are
+        # left out, conversions between text and tokens get inserted, and with more
+        # than one job all token passes run in parallel instead.
+        stages = []
+        state = Pass.TEXT
+        for p in ScriptObfuscator.PASSES:
+            if p.name not in self.passes: continue
+            if any(x not in self.passes for x in p.requires): continue
+
+            if p.consumes != state:
+                stages.append([ScriptObfuscator.TOKENIZE if state == Pass.TEXT else ScriptObfuscator.JOIN])
+                state = p.consumes
+
+            if self.jobs > 1 and p.consumes == Pass.TOKENS:
+                if stages[-1] != [ScriptObfuscator.PARALLEL]:
+                    stages.append([ScriptObfuscator.PARALLEL])
+            elif p.line and stages and stages[-1][-1].line:
+                stages[-1].append(p)
+            else:
+                stages.append([p])
+            state = p.produces
+
+        if state == Pass.TOKENS:
+            stages.append([ScriptObfuscator.JOIN])
+        return stages
+
+    def runPasses(self):
+        stages = self.pipeline()
+        for stage in stages:
+            name = '+'.join(p.name for p in stage)
+            if stage[0].line:
+                self.runPass(name, self.runFused, stage)
+            elif stage[0].consumes == Pass.TEXT and stage[0].produces == Pass.TEXT:
+                self.runPass(name, getattr(self, stage[0].run), self.buffer)
+            else:
+                self.runPass(name, getattr(self, stage[0].run))
+
+        if not stages or stages[-1][0] is not ScriptObfuscator.JOIN:
+            if self.stream is not None:
+                return self.buffer.write(self.stream)
+            self.output = self.buffer.text()
 
-        # Remove comments
-        self.removeComments()
+        if self.stream is not None:
+            return self.written
+        return self.output
 
-        # Rename used variables
-        self.randomizeVariablesAndFunctions()
+    def runFused(self, stage):
+        self.tokens = self.mapLines(
+            [getattr(self, p.line) for p in stage],
+            [getattr(self, p.finish) for p in stage if p.finish])
 
-        # Obfuscate arrays
-        self.obfuscateArrays()
+    def join(self):
+        # Once all passes are done the tokens go straight into the stream, if there
+        # is one, rather than getting joined whole.
+        if self.stream is not None:
+            self.written = ScriptLexer.write(self.tokens, self.stream)
+        else:
+            self.output = ScriptLexer.join(self.tokens)
+            self.buffer = EditBuffer(self.output)
 
-        # Insert garbage
-        # TODO: Garbage insertion is flawed at the moment, resulting in inserting
-        #       junk lines that breaks line continuations (lines ending with '_').
-        #self.insertGarbage()
+    def runPass(self, name, method, *args):
+        if not self.profiler:
+            return method(*args)
+        return self.profiler.run(self, name, method, *args)
 
-        # Remove indents and multi-spaces.
-        self.output = self.removeIndents(self.output)
-        self.output = self.removeEmptyLines(self.output)
+    def count(self, name, value):
+        # Counters of the pass being profiled, meant to be called once per pass.
+        if self.profiler:
+            self.profiler.count(name, value)
 
-        return self.output
+    def currentSize(self):
+        if self.tokens:
+            return sum([len(tok[1]) for tok in self.tokens])
+        return len(self.buffer)
+
+    def tokenize(self):
+        self.tokens = ScriptLexer.tokenizeSpans(self.buffer.spans())
+        self.reserveIdentifiers(self.tokens)
+        self.count('tokens', len(self.tokens))
+
+    def reserveIdentifiers(self, tokens):
+        self.names.reserve(set(text for (kind, text) in tokens if kind == ScriptLexer.IDENTIFIER))
 
     def addDeobfuscator(self):
         if not self.deobfuscatorAddedOnce:
-            deobfuscatorFunction = self.bitShuffleObfuscator.getDeobfuscatorCode()
-            #deobfuscatorFunction = self.removeIndents(deobfuscatorFunction)
-            deobfuscatorFunction = self.removeEmptyLines(deobfuscatorFunction)
-            info("Appending bit shuffle string deobfuscation routines.")
-            self.output += '\n%s' % deobfuscatorFunction
+            self.tokens.extend(self.deobfuscatorTokens())
             self.deobfuscatorAddedOnce = True
 
-    def removeEmptyLines(self, txt):
-        return '\n'.join(filter(lambda x: not re.match(r'^\s*$', x), txt.split('\n')))
-
-    def removeIndents(self, txt):
-        if DEBUG:
-            return txt
-        txt = re.sub(r"\t| {2,}", "", txt, flags=re.I)
-        lines = txt.split('\n')
-        newLines = []
-        # Have to be this way instead of finditer due to regex wrongly matching line breaks
-        for i in range(len(lines)):
-            line = lines[i]
-            outLine = line
-            for m in re.finditer(r"\s*(\+|\-|\/|\*|\=|\\|\,|\>|\<|\<\>|\^)\s*(?!\_)", line, flags=re.I):
-                if '_' in line[m.span()[1]:]: continue
-                outLine = outLine.replace(m.group(0), m.group(1))
-            newLines.append(outLine)
-        txt = '\n'.join(newLines)
-        return txt
-
-    def removeComments(self):
-        lines = self.output.split('\n')
-        for i in range(len(lines)):
-            line = lines[i]
-            m = re.search(r"('.*)", lines[i], flags=re.I)
-            if not m: 
+    def deobfuscatorTokens(self):
+        deobfuscatorFunction = EditBuffer(self.bitShuffleObfuscator.getDeobfuscatorCode())
+        self.removeEmptyLines(deobfuscatorFunction)
+        info("Appending bit shuffle string deobfuscation routines.")
+        tokens = ScriptLexer.tokenizeSpans(deobfuscatorFunction.spans())
+        self.reserveIdentifiers(tokens)
+        return [(ScriptLexer.NEWLINE, '\n')] + tokens
+
+    def splitAtProcedures(self):
+        # Cuts the token stream at the beginnings of procedures into segments of
+        # similar size. Cuts fall on logical line starts, so no statement, continued
+        # line or hoisted literal ever spans two segments.
+        self.detectFunctionBoundaries(self.tokens)
+        lineOffsets = ScriptLexer.lineOffsets(self.tokens)
+
+        # Character offset of every physical line start, to map function starts onto.
+        lineStarts = [0]
+        pos = 0
+        for i in range(len(self.tokens)):
+            pos += len(self.tokens[i][1])
+            if self.tokens[i][0] == ScriptLexer.NEWLINE:
+                lineStarts.append(pos)
+
+        cuts = []
+        for func in self.function_boundaries:
+            lineNum = bisect.bisect_right(lineStarts, func.funcStart) - 1
+            while lineNum > 0 and self.tokens[lineOffsets[lineNum] - 2][0] == ScriptLexer.CONTINUATION:
+                lineNum -= 1
+            if lineOffsets[lineNum] > 0 and (not cuts or lineOffsets[lineNum] > cuts[-1]):
+                cuts.append(lineOffsets[lineNum])
+
+        target = len(self.tokens) // max(self.jobs * ScriptObfuscator.SEGMENTS_PER_JOB, 1)
+        segments = []
+        start = 0
+        for cut in cuts:
+            if cut - start >= target:
+                segments.append(self.tokens[start:cut])
+                start = cut
+        segments.append(self.tokens[start:])
+        return segments
+
+    def obfuscateInParallel(self):
+        # Same passes as the serial pipeline, run over procedure segments by a pool
+        # of processes. Renames need the whole file to be known, hence two rounds:
+        # the first one obfuscates strings and collects rename candidates, the
+        # parent picks the new names once, the second one applies them.
+        segments = self.splitAtProcedures()
+        renames = self.parameterRenames() if 'obfuscateStrings' in self.passes else {}
+        settings = self.settings()
+
+        # Each segment draws from a stream of its own, derived from this one in
+        # file order, for the output not to depend on scheduling.
+        seeds = [self.random.getrandbits(64) for x in range(len(segments) + 1)]
+        logging = (logLevel(), logColors())
+
+        # Names of variables that literals too long for a line get hoisted into are
+        # allocated here, for them to be unique across segments.
+        names = [[] for x in segments]
+        if 'obfuscateStrings' in self.passes:
+            for i in range(len(segments)):
+                hoisted = sum(1 for (kind, text) in segments[i] if kind == ScriptLexer.STRING and len(text) - 2 > MAX_LINE_LENGTH)
+                names[i] = self.names.allocateMany(hoisted, 8, 12)
+
+        info("Obfuscating %d segments with %d workers.", len(segments), min(self.jobs, len(segments)))
+
+        pool = multiprocessing.Pool(min(self.jobs, len(segments)))
+        try:
+            results = pool.map(obfuscateSegmentStrings, [(settings, seeds[i], segments[i], renames, names[i], logging) for i in range(len(segments))])
+            writeLogs(x[2] for x in results)
+
+            if 'obfuscateStrings' in self.passes and 'addDeobfuscator' in self.passes:
+                results.append(obfuscateSegmentStrings((settings, seeds[-1], self.deobfuscatorTokens(), None, [], logging)))
+
+            # Candidates are merged in file order, to claim names as the serial run does.
+            replacedAlready = {}
+            if 'randomizeVariablesAndFunctions' in self.passes:
+                candidates = tuple([] for x in results[0][1])
+                for (tokens, found, log) in results:
+                    for (merged, part) in zip(candidates, found):
+                        merged.extend(part)
+                replacedAlready = self.chooseNames(candidates)
+                self.renames.update(replacedAlready)
+                info("Randomized %d names in total.", len(replacedAlready))
+            self.count('segments', len(segments))
+            self.count('names', len(replacedAlready))
+
+            segments = pool.map(obfuscateSegmentNames, [(settings, seeds[i], results[i][0], replacedAlready, logging) for i in range(len(results))])
+            writeLogs(x[1] for x in segments)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.tokens = [tok for (segment, log) in segments for tok in segment]
+        self.deobfuscatorAddedOnce = True
+        if 'removeEmptyTokenLines' in self.passes:
+            self.removeEmptyTokenLines()
+
+    def removeEmptyLines(self, buffer):
+        # Runs of blank lines get deleted along with their line breaks. Blank lines
+        # ending the text take the break of the last line left with them. Running
+        # first, the pass gets the input itself out of the buffer, not a copy.
+        text = buffer.text()
+        end = len(text)
+        while end and text[end - 1].isspace():
+            end -= 1
+        stop = text.find('\n', end) if end else 0
+
+        edits = [(m.start(), m.end(), '') for m in ScriptObfuscator.BLANK_LINES_REGEX.finditer(text, 0, stop if stop != -1 else len(text))]
+        if stop != -1:
+            edits.append((stop, len(text), ''))
+
+        buffer.edit(edits)
+        if self.profiler:
+            self.count('lines_removed', sum(text.count('\n', start, stop) for (start, stop, _) in edits))
+
+    def removeEmptyTokenLines(self):
+        self.tokens = self.mapLines([self.removeEmptyTokenLine], [self.dropTrailingNewline])
+
+    def removeEmptyTokenLine(self, line):
+        if not ScriptLexer.isBlankLine(line):
+            return line
+        if self.profiler: self.count('lines_removed', 1)
+        return None
+
+    def dropTrailingNewline(self, tokens):
+        if tokens and tokens[-1][0] == ScriptLexer.NEWLINE:
+            tokens.pop()
+        return tokens
+
+    def removeLineIndents(self, line):
+        if self.debug:
+            return line
+
+        operators = ScriptObfuscator.INDENT_OPERATORS
+        tokens = []
+
+        for i in range(len(line)):
+            kind, text = line[i]
+            if kind != ScriptLexer.WHITESPACE:
+                tokens.append(line[i])
+                continue
+
+            # Indentation and trailing whitespace
+            if i == 0 or i + 1 == len(line) or line[i + 1][0] == ScriptLexer.NEWLINE:
+                continue
+
+            # Whitespace around operators
+            if (line[i - 1][0] == ScriptLexer.OPERATOR and line[i - 1][1] in operators) or \
+                (line[i + 1][0] == ScriptLexer.OPERATOR and line[i + 1][1] in operators):
                 continue
 
-            # BUG: This loop does not detect comments added by `obfuscateString` to surround 
-            #       'Declare PtrSafe Function' instructions. The loop cannot detect whether m.group(1)
-            #       that is currently regex-matched comment has been marked with avoid-removing by being
-            #       added to the `self.avoidRemovingTheseComments` list.
-            
-            # avoidComment = False
-            # for avoid in self.avoidRemovingTheseComments:
-            #   if m.group(1) in avoid:
-            #       dbg("\tThis comment is marked to be avoided from removing: {{ %s }}" % m.group(1))
-            #       avoidComment = True
-            #       break
-
-            # if avoidComment: continue
-
-            dbg("\tChecking if comment (%s) is inside of a string: (%s)" % (m.group(1), lines[i]))
-            n = re.search(r"(\"[^\"']*('[^\"]*)\")", lines[i], flags=re.I)
-
-            if not n:
-                dbg("\tNope, it's not.")
-                o = re.match(r"^\s*'.*", m.group(1), flags=re.I)
-                if o:
-                    dbg("\tSince the comment opens the line, the entire line gets wiped out.")
-                    lines[i] = ''
-                else:
-                    lines[i] = line.replace(m.group(1), '')
-                info("Found comment: (%s)" % m.group(1))
+            # Multi-spaces
+            tokens.append((ScriptLexer.WHITESPACE, ' '))
+
+        if self.profiler: self.count('tokens_removed', len(line) - len(tokens))
+        return tokens
+
+    def removeLineComment(self, line):
+        for i in range(len(line)):
+            if line[i][0] != ScriptLexer.COMMENT:
+                continue
+
+            info("Found comment: (%s)", line[i][1])
+
+            # Strip the comment together with whitespace leading to it. A comment
+            # opening the line leaves an empty line behind.
+            j = i
+            while j > 0 and line[j - 1][0] == ScriptLexer.WHITESPACE:
+                j -= 1
+            if self.profiler: self.count('comments', 1)
+            return line[:j] + line[i + 1:]
+        return line
+
+    def mapLines(self, functions, finishers = ()):
+        # One traversal of the token stream, every physical line going through all of
+        # the line functions in turn. A function returning None drops the line.
+        # Finishers get the resulting token list once all lines are done.
+        tokens = []
+        for line in ScriptLexer.lines(self.tokens):
+            for function in functions:
+                line = function(line)
+                if line is None: break
             else:
-                dbg("\tYes it is. (group: (%s))" % n.group(1))
+                tokens.extend(line)
 
-                if m.group(1) not in n.group(1) and m.group(1) not in lines[i]:
-                    info("Found comment: (%s)" % m.group(1))
-                    lines[i] = line.replace(m.group(1), '')
+        for finisher in finishers:
+            tokens = finisher(tokens)
+        return tokens
 
-        self.output = '\n'.join(lines)
+    def detectFunctionBoundaries(self, tokens = None):
+        # Procedures are looked for on the tokens of the output, so that neither
+        # 'End Sub' within strings or comments, nor End If / End With / End Select
+        # are taken for the end of one. Other tokens than those of the output may
+        # be passed in.
+        del self.function_boundaries[:]
+        self.function_names = {}
 
-    def detectFunctionBoundaries(self):
+        modifiers = ('public', 'private', 'protected', 'friend', 'static')
+        procedures = ('sub', 'function')
+        current = None
+        continued = False
         pos = 0
-        del self.function_boundaries[:]
-        funcStart = 0
-        funcStop = 0
-        counter = 0
-
-        for m in re.finditer(ScriptObfuscator.FUNCTION_REGEX, self.output, flags=re.I|re.M):
-            if pos >= len(self.output): break
-
-            funcName = m.group(1)
-            funcStart = m.span()[0] + (len(m.group(0)) - len(m.group(0).lstrip()))
-            
-            if counter > 0: 
-                rev = self.output[pos:funcStart].rfind('End Sub')
-                if rev == -1:
-                    rev = self.output[pos:funcStart].rfind('End Function')
-
-                prev_end = pos + rev
-                pos = prev_end
-                self.function_boundaries[counter - 1]['funcStop'] = prev_end
-                prev = self.function_boundaries[counter - 1]
-                info("Function boundaries: (%s, from: %d, to: %d)" % (prev['funcName'], prev['funcStart'], prev['funcStop']))
-            
-            elem = {
-                'funcName' : funcName,
-                'funcStart' : funcStart,
-                'funcStop' : -1
-            }
-            self.function_boundaries.append(elem)
-            counter += 1
-
-    def isInsideFunc(self, pos, offset = 0):
-        for func in self.function_boundaries:
-            if pos > (offset + func['funcStart']) and pos < (offset + func['funcStop']):
-                return True
-        return False
 
-    def getFuncBoundaries(self, name):
-        for func in self.function_boundaries:
-            if name == func['funcName']:
-                return func
-        return None
+        def close(func, funcStop):
+            func.funcStop = funcStop
+            info("Function boundaries: (%s, from: %d, to: %d)", func.funcName, func.funcStart, func.funcStop)
+
+        if tokens is None:
+            tokens = self.tokens
+
+        for line in ScriptLexer.lines(tokens):
+            # Leading words of the line along with the offset of the first one.
+            words = []
+            first = -1
+            offset = pos
+            for (kind, text) in line:
+                if kind == ScriptLexer.IDENTIFIER:
+                    if first == -1: first = offset
+                    words.append(text)
+                    if len(words) == 4: break
+                elif kind != ScriptLexer.WHITESPACE:
+                    break
+                offset += len(text)
 
-    def findLongLines(self, txt, pos0, lineStart0 = 0, lineStop0 = 0):
-        rex = ScriptObfuscator.LONG_LINES_REGEX
-        pos = pos0
-        varName = None
-        longLine = None
-        origLine = None
-        lineStart = lineStart0
-        lineStop = lineStop0
-  
-        dbg("Searching for long lines.", bcolors.OKBLUE)
-        while pos < len(txt):
-            dbg("Searching for long lines regex: POS = %d" % pos, bcolors.OKGREEN)
-            m = re.search(rex, txt[pos:], flags=re.I|re.M)
-            if not m: 
-                break
+            startsStatement = not continued
+            continued = len(line) > 1 and line[-2][0] == ScriptLexer.CONTINUATION
+            pos += sum(len(text) for (kind, text) in line)
+            if not startsStatement or not words:
+                continue
 
-            varName = m.group(1)
-            longLine = m.group(2)
-
-            endOfLine = pos + txt[pos:].find('\n')
-            suffix = txt[pos:endOfLine + 1]
-            
-            lineStart = pos + m.span()[0]
-
-            pos += m.span()[1]
-            pos += len(suffix)      
-            lineStop = pos - 1
-
-            dbg("This is candidate for a long line (pos=%d, lineStart=%d, lineStop=%d, span: %s):\n{{ %s }}\n" % (pos, lineStart, lineStop, str(m.span()), longLine))
-            assert lineStart < lineStop
-
-            while True:
-                if pos >= len(txt): break
-                endOfLine = pos + txt[pos:].find('\n')
-                line = txt[pos:endOfLine]
-                dbg("\tDoes this line contains strings? (pos=%d, end=%d):\n\t{{ %s }}\n" % (pos,endOfLine,line))
-                fault = False
-                if endOfLine < pos:
-                    fault = True
-                    endOfLine, pos = pos, endOfLine
-                    line = txt[pos:]
-
-                dbg("\tWe will find out by matching this line: pos=%d, endOfLine=%d,\n{{ %s }}" % (pos, endOfLine, line))
-                n = re.match(rex, line, flags=re.I|re.M)
-                if fault:
-                    pos += endOfLine + 1
-                else:
-                    pos += endOfLine - pos + 1
-
-                if not n: 
-                    dbg("\tOoops, not matching seemingly.")
-                    if len(longLine) > SPLIT:
-                        origLine = txt[lineStart:lineStop]
-                        dbg("Although this is helluva long line - %d bytes! Gotta break it up. (lineStart=%d, lineStop=%d, pos=%d):\n{{ %s }}\n" % (len(longLine), lineStart, lineStop, pos, longLine))
-                        return (varName, origLine, longLine, pos, lineStart, lineStop)
-                    break
+            lowered = [x.lower() for x in words]
+            if current and lowered[0] == 'end' and lowered[1:2] and lowered[1] in procedures:
+                close(current, first)
+                current = None
+                continue
 
-                dbg("\tYes. It matches smoothly: (%s)" % n.group(2))
-                longLine += n.group(2)
-                lineStop = endOfLine
-                
-            assert lineStart < lineStop
-            lineStop = pos
+            while lowered and lowered[0] in modifiers:
+                lowered.pop(0)
 
-        origLine = txt[lineStart:lineStop]
-        dbg("Found long line (lineStart=%d, lineStop=%d, pos=%d):\n{{ %s }}\n" % (lineStart, lineStop, pos, origLine))
-        return (varName, origLine, longLine, pos, lineStart, lineStop)
+            if len(lowered) < 2 or lowered[0] not in procedures:
+                continue
 
-    def mergeAndConcatLongLines(self, txt):
-        replaces = []
-        pos = 0
-        lineStart = 0
-        lineStop = 0
-        
-        while True:
-            (varName, origLine, longLine, pos, lineStart, lineStop) = self.findLongLines(txt, pos, lineStart, lineStop)
-            if not origLine or not longLine: break
-            dbg("AFTER Searching for acompanying lines. Returned: varName = (%s), pos=%d, lineStart=%d, lineStop = %d\n\torigLine = {{ %s }}\n\tlongLine = {{ %s }}" % (varName, pos, lineStart, lineStop, origLine, longLine))
-            newLine = ''
-            for s in range(len(longLine) / SPLIT + 1):
-                fr = s * SPLIT
-                to = fr + SPLIT
-                if newLine == '':
-                    newLine += '\n%s = "%s"\n' % (varName, longLine[fr:to])
-                else:
-                    newLine += '%s = %s + "%s"\n' % (varName, varName, longLine[fr:to])
-
-            dbg("Full long line joined altogether:\n{{ %s }}\n" % longLine)
-            if len(longLine) < SPLIT:
-                dbg("Too short to be replaced (%s)..." % longLine)
+            # Unterminated procedure ends where the next one starts.
+            if current:
+                close(current, first)
+
+            current = FunctionBoundary(words[len(words) - len(lowered) + 1], first)
+            self.function_boundaries.append(current)
+
+        if current:
+            close(current, pos)
+
+        for func in self.function_boundaries:
+            self.function_names.setdefault(func.funcName.lower(), func)
+
+    def getFuncBoundaries(self, name):
+        return self.function_names.get(name.lower())
+
+    def mergeLongLines(self, buffer):
+        # Single forward pass over the lines. A run of lines building up one string
+        # literal, either through ' _' continuations or through consecutive
+        # 'var = var + "..."' appends, gets merged and split again into SPLIT-sized
+        # 'var = var + "..."' chunks. Only the lines of the current run are buffered,
+        # and runs rewritten are yielded as edits (start, stop, text) of the buffer.
+        rex = re.compile(ScriptObfuscator.LONG_LINES_REGEX, flags=re.I)
+        run = []
+        parts = []
+        varName = None
+        continued = False
+        matches = 0
+        runs = 0
+        start = 0
+        offset = 0
+
+        for line in buffer.lines():
+            lineStart = offset
+            offset += len(line) + 1
+            m = rex.match(line)
+            if m: matches += 1
+            if m and line[m.end():].strip():
+                # Something else follows the literal, that line cannot be merged.
+                m = None
+
+            if run and m and (
+                (continued and not m.group(1)) or
+                (not continued and m.group(2) and m.group(1).lower() == varName.lower())
+            ):
+                run.append(line)
+                parts.append(m.group(3))
+                continued = m.group(4) is not None
                 continue
-            else:
-                dbg("This line will get merged:\n{{ %s }}\nINTO:\n{{ %s }}\n" % (origLine, newLine))
-                replaces.append((origLine, newLine, longLine))
-                if pos >= len(txt): break
 
-        for (orig, new, longLine) in replaces:
-            if DEBUG:
-                dbg("Merging long line:\n\t{{ %s }}\n\t======>\n\t{{ %s }}\n\n" % (orig, new))
+            if run:
+                # The run ended with the line break before this line.
+                merged = self.concatLongLine(run, parts, continued, buffer, start)
+                if merged is not None:
+                    yield (start, lineStart - 1, '\n'.join(merged))
+                runs += 1
+                run = []
+                parts = []
+
+            if m and m.group(1):
+                varName = m.group(1)
+                run.append(line)
+                parts.append(m.group(3))
+                continued = m.group(4) is not None
+                start = lineStart
+
+        if run:
+            merged = self.concatLongLine(run, parts, continued, buffer, start)
+            if merged is not None:
+                yield (start, offset - 1, '\n'.join(merged))
+            runs += 1
+
+        self.count('matches', matches)
+        self.count('runs', runs)
+
+    def concatLongLine(self, run, parts, continued, buffer, offset):
+        # New lines for the run, or None when it is left as it is.
+        length = sum(map(len, parts))
+
+        if continued or length <= SPLIT:
+            # Too short, or the last line continues into something else than a literal.
+            dbg("Leaving lines as they are (len: %d)", length)
+            return None
+
+        m = re.match(ScriptObfuscator.LONG_LINES_REGEX, run[0], flags=re.I)
+        varName = m.group(1)
+        indent = run[0][:len(run[0]) - len(run[0].lstrip())]
+        info("Merging long string line at offset %d of the input (var: %s, len: %d): '%s...%s'", buffer.originalOffset(offset), varName, length, parts[0][:40], parts[-1][-40:])
+
+        # The merged literal is never joined, chunks are cut straight out of its parts.
+        lines = []
+        for chunk in iterChunks(parts, SPLIT):
+            if not lines and not m.group(2):
+                lines.append('%s%s = "%s"' % (indent, varName, chunk))
             else:
-                info("Merging long string line (var: %s, len: %d): '%s...%s'" % (varName, len(longLine), longLine[:40], longLine[-40:]))
-            txt = txt.replace(orig, new)
+                lines.append('%s%s = %s + "%s"' % (indent, varName, varName, chunk))
+        return lines
 
-        return txt
+    def mergeAndConcatLongLines(self, buffer):
+        buffer.edit(list(self.mergeLongLines(buffer)))
 
 
     def randomizeVariablesAndFunctions(self):
+        (candidates, identifiers) = self.discoverNames()
+        replacedAlready = self.chooseNames(candidates)
+        self.renameIdentifiers(replacedAlready, identifiers)
+        self.renames.update(replacedAlready)
+        info("Randomized %d names in total.", len(replacedAlready))
+
+        if self.profiler:
+            self.count('matches', sum(len(x) for x in candidates))
+            self.count('names', len(replacedAlready))
+            self.count('identifiers', sum(len(identifiers.get(x, ())) for x in replacedAlready))
+
+    def discoverNames(self):
+        # Candidates per discovery kind, kept apart so that the first kind to claim
+        # a name (in the order of chooseNames) decides which filters apply to it.
+        variables = []
+        globalNames = []
+        declares = []
+        params = []
+        functions = []
+
+        # Identifier index: lowercased name => list of token indices in self.tokens.
+        # Member accesses (obj.name) are not indexed, as they must not be renamed.
+        identifiers = {}
+
+        tokens = self.tokens
+        sig = []
+
+        def word(j):
+            # Lowercased identifier at the j-th significant token of the statement,
+            # '' for any other token or past its end.
+            if 0 <= j < len(sig) and tokens[sig[j]][0] == ScriptLexer.IDENTIFIER:
+                return tokens[sig[j]][1].lower()
+            return ''
+
+        def op(j):
+            if 0 <= j < len(sig) and tokens[sig[j]][0] == ScriptLexer.OPERATOR:
+                return tokens[sig[j]][1]
+            return ''
+
+        def declaredNames(j):
+            # (name, typed) of every variable of a list starting at the j-th significant
+            # token, like in: name[(bounds)] [As Type] [= value], name2 ... where typed
+            # tells whether As follows the name.
+            names = []
+            while word(j):
+                name = tokens[sig[j]][1]
+                (depth, typed) = (0, None)
+                j += 1
+                while j < len(sig):
+                    if op(j) == '(': depth += 1
+                    elif op(j) == ')': depth -= 1
+                    elif depth == 0 and op(j) in (',', ':'): break
+                    elif depth == 0 and typed is None: typed = word(j) == 'as'
+                    j += 1
+                names.append((name, typed))
+                if op(j) != ',': break
+                j += 1
+            return names
+
+        def discoverStatement():
+            found = []
+            first = word(0)
+            if first in ('set', 'const'):
+                found.extend((variables, name) for (name, typed) in declaredNames(1))
+            elif first in ('public', 'private', 'protected'):
+                j = 2 if word(1) in ('dim', 'set', 'const') else 1
+                found.extend((globalNames, name) for (name, typed) in declaredNames(j) if typed)
+            elif first and op(1) == '=':
+                found.append((variables, tokens[sig[0]][1]))
+
+            for j in range(len(sig)):
+                w = word(j)
+                if not w or ScriptLexer.isMemberAccess(tokens, sig[j]): continue
+                if w in ('dim', 'redim'):
+                    k = j + 2 if word(j + 1) == 'preserve' else j + 1
+                    found.extend((variables, name) for (name, typed) in declaredNames(k))
+                elif w == 'declare':
+                    # Declare [PtrSafe] Sub|Function name Lib "lib" [Alias "symbol"]: only
+                    # the name of an aliased one may change, the alias keeps the symbol.
+                    k = j + 2 if word(j + 1) == 'ptrsafe' else j + 1
+                    if word(k) in ('sub', 'function') and word(k + 2) == 'lib' and word(k + 4) == 'alias':
+                        found.append((declares, tokens[sig[k + 1]][1]))
+                elif w in ('sub', 'function') and word(j + 1) and op(j + 2) == '(':
+                    funcName = tokens[sig[j + 1]][1]
+                    (k, depth) = (j + 3, 1)
+                    while k < len(sig) and depth > 0:
+                        if op(k) == '(': depth += 1
+                        elif op(k) == ')': depth -= 1
+                        elif depth == 1 and word(k) and word(k + 1) == 'as' and word(k + 2):
+                            params.append((funcName, tokens[sig[k]][1]))
+                        k += 1
+                    found.append((functions, funcName))
+            return found
+
+        # Single scan over the token stream, a logical line at a time, collecting
+        # both the rename candidates and the occurrences of every identifier.
+        # Comments are still there at this point and left out, so that no
+        # declaration-looking text within them makes names of the code candidates.
+        start = 0
+        for i in range(len(tokens) + 1):
+            kind = tokens[i][0] if i < len(tokens) else ScriptLexer.NEWLINE
+            if kind == ScriptLexer.NEWLINE:
+                if i < len(tokens) and i > 0 and tokens[i - 1][0] == ScriptLexer.CONTINUATION: continue
+                if sig:
+                    found = discoverStatement()
+                    if found:
+                        context = ScriptLexer.elidedLineText(tokens[start:i])
+                        for (candidates, name) in found:
+                            candidates.append((context, name))
+                    sig = []
+                start = i + 1
+            elif kind == ScriptLexer.IDENTIFIER:
+                if not ScriptLexer.isMemberAccess(tokens, i):
+                    identifiers.setdefault(tokens[i][1].lower(), []).append(i)
+                sig.append(i)
+            elif kind != ScriptLexer.WHITESPACE and kind != ScriptLexer.COMMENT and kind != ScriptLexer.CONTINUATION:
+                sig.append(i)
+
+        return ((variables, globalNames, declares, params, functions), identifiers)
+
+    def chooseNames(self, candidates):
+        (variables, globalNames, declares, params, functions) = candidates
         replacedAlready = {}
+        verbose = logEnabled(LOG_VERBOSE)
 
-        def replaceVar(name, m):
-            varName = randomString(random.randint(4,12))
-            varToReplace = ''
+        def replaceVar(name, context, varToReplace):
+            if varToReplace.lower() in replacedAlready: return
+            if len(varToReplace) < self.min_var_length: return
+            if varToReplace.casefold() in self.reserved: return
+            varName = self.names.allocate(4, 12)
 
-            if m and len(m.groups()) > 0:
-                for a in m.groups():
-                    if a and len(a) > 0:
-                        varToReplace = a
-                        break
-
-                if varToReplace in replacedAlready.keys(): return
-                if len(varToReplace) < self.min_var_length: return
-                if varToReplace in self.reserved_words: return
-
-                info(name + " name obfuscated (context: \"%s\"): '%s' => '%s'" % (m.group(0).strip(), varToReplace, varName))
-                replacedAlready[varToReplace] = varName
+            if verbose: info("%s name obfuscated (context: \"%s\"): '%s' => '%s'", name, context.strip(), varToReplace, varName)
+            replacedAlready[varToReplace.lower()] = varName
 
         # Variables
-        for m in re.finditer(ScriptObfuscator.VARIABLES_REGEX, self.output, flags = re.I|re.M):
-            replaceVar('Variable', m)
-
-        for m in re.finditer(ScriptObfuscator.VARIABLE_DECLARATIONS_REGEX, self.output, flags = re.I|re.M):
-            replaceVar('Variable', m)
+        for (context, varToReplace) in variables:
+            replaceVar('Variable', context, varToReplace)
 
         # Globals
-        for m in re.finditer(ScriptObfuscator.GLOBALS_REGEX, self.output, flags = re.I|re.M):
-            replaceVar('Global', m)
+        for (context, varToReplace) in globalNames:
+            replaceVar('Global', context, varToReplace)
 
         # Globals
-        for m in re.finditer(ScriptObfuscator.PTRSAFE_FUNCTIONS_REGEX, self.output, flags = re.I|re.M):
-            replaceVar('Declare Function', m)
+        for (context, varToReplace) in declares:
+            replaceVar('Declare Function', context, varToReplace)
 
-        for m in re.finditer(ScriptObfuscator.FUNCTION_REGEX, self.output, flags = re.I|re.M):
-            pos = m.span()[0]
-            funcName = m.group(1)
-
-            for n in re.finditer(ScriptObfuscator.FUNCTION_PARAMETERS_REGEX, m.group(0), flags=re.I|re.M):
-                pos2 = n.span()[0]
-                varName = randomString(random.randint(4,12))
-                varToReplace = n.group(1)
-
-                if varToReplace in replacedAlready.keys(): continue
-                replacedAlready[varToReplace] = varName
-                info("Function: (%s): Adding variable obfuscation: (%s) => (%s)" % (funcName, varToReplace, varName))
+        for (funcName, varToReplace) in params:
+            if varToReplace.lower() in replacedAlready: continue
+            if varToReplace.casefold() in self.reserved: continue
+            varName = self.names.allocate(4, 12)
+            replacedAlready[varToReplace.lower()] = varName
+            if verbose: info("Function: (%s): Adding variable obfuscation: (%s) => (%s)", funcName, varToReplace, varName)
 
         # Function names
-        for m in re.finditer(ScriptObfuscator.FUNCTION_REGEX, self.output, flags = re.I|re.M):
-            varName = randomString(random.randint(4,12))
-            varToReplace = m.group(1)
-            
+        for (context, varToReplace) in functions:
             if len(varToReplace) < self.min_var_length: continue
-            if varToReplace in self.reserved_words: continue
-            if varToReplace in ScriptObfuscator.RESERVED_NAMES: continue
-            if varToReplace in replacedAlready.keys(): continue
-            
-            info("Function name obfuscated (context: \"%s\"): '%s' => '%s'" % (m.group(0).strip(), varToReplace, varName))
-            #self.output = re.sub(r"\b" + varToReplace + r"\b", varName, self.output, flags=re.I | re.M)
-            replacedAlready[varToReplace] = varName
+            if varToReplace.casefold() in self.reserved: continue
+            if varToReplace.lower() in replacedAlready: continue
+            varName = self.names.allocate(4, 12)
 
-        for (varToReplace, varName) in replacedAlready.items():
-            dbg("Obfuscate variable name: (%s) => (%s)" % (varToReplace, varName))
-            self.output = re.sub(r"(?<!\.)(?:\b" + varToReplace + r"\b)|(?:\b" + varToReplace + r"\s*=\s*)", varName, self.output, flags=re.I | re.M)
+            if verbose: info("Function name obfuscated (context: \"%s\"): '%s' => '%s'", context.strip(), varToReplace, varName)
+            replacedAlready[varToReplace.lower()] = varName
 
-        info("Randomized %d names in total." % len(replacedAlready))
+        return replacedAlready
 
-    @staticmethod
-    def obfuscateNumber(num):
-        rnd1 = random.randint(0, 3333)
-        num_coders = (
-            lambda rnd1, num: '%d' % num,
-            lambda rnd1, num: '%d-%d' % (rnd1+num, rnd1),
-            lambda rnd1, num: '%d-%d' % (2*rnd1+num, 2*rnd1),
-            lambda rnd1, num: '%d-%d' % (3*rnd1+num, 3*rnd1),
-            lambda rnd1, num: '%d+%d' % (-rnd1, rnd1+num),
-            lambda rnd1, num: '%d/%d' % (rnd1*num, rnd1),
-        )
-
-        out = random.choice(num_coders)(rnd1, num)
-        if '/0' in out: 
-            # Ooops, it cannot be happen!
-            out = '%d' % num
-        return out
+    def renameIdentifiers(self, replacedAlready, identifiers = None):
+        if identifiers is None:
+            identifiers = {}
+            for i in range(len(self.tokens)):
+                if self.tokens[i][0] != ScriptLexer.IDENTIFIER: continue
+                if ScriptLexer.isMemberAccess(self.tokens, i): continue
+                identifiers.setdefault(self.tokens[i][1].lower(), []).append(i)
 
-    @staticmethod
-    def obfuscateChar(char):
-        char_coders = (
-            lambda x: '"{}"'.format(x), # 0
-            lambda x: 'Chr(&H%x)' % ord(x), # 1
-            lambda x: 'Chr(%d)' % ord(x), # 2
-            lambda x: 'Chr(%s)' % ScriptObfuscator.obfuscateNumber(ord(x)), # 3
-            lambda x: 'Chr(Int("&H%x"))' % ord(x), # 4
-            lambda x: 'Chr(Int("%d"))' % ord(x), # 5
-        )
-        return random.choice(char_coders)(char)
+        # Rewrite the indexed identifier tokens in place.
+        debug = logEnabled(LOG_DEBUG)
+        for (varToReplace, varName) in replacedAlready.items():
+            if debug: dbg("Obfuscate variable name: (%s) => (%s)", varToReplace, varName)
+            for i in identifiers.get(varToReplace, ()):
+                self.tokens[i] = (ScriptLexer.IDENTIFIER, varName)
+
+    def obfuscateNumber(self, num):
+        return self.obfuscateNumbers((num,))[0]
+
+    def obfuscateNumbers(self, nums):
+        # Coders and offsets of all numbers get drawn in one go, as uniformly as
+        # choice() and randint() would draw them.
+        rand = self.random.random
+        coders = ScriptObfuscator.NUMBER_CODERS
+        return [coders[int(rand() * 6)](int(rand() * 3334), num) for num in nums]
+
+    def obfuscateChar(self, char):
+        return self.obfuscateChars(char)[0]
+
+    def obfuscateChars(self, chars):
+        # Same for characters. Those encoded by their code as an obfuscated number
+        # get their numbers in one batch too.
+        rand = self.random.random
+        formats = ScriptObfuscator.CHAR_CODERS
+        picks = [int(rand() * 6) for x in range(len(chars))]
+        numbers = iter(self.obfuscateNumbers([ord(c) for (c, p) in zip(chars, picks) if p == 3]))
+        return [formats[p] % (c if p == 0 else next(numbers) if p == 3 else ord(c)) for (c, p) in zip(chars, picks)]
 
     def obfuscateString(self, string):
         return self.obfuscateStringBySubstitute(string)
 
     def obfuscateStringBySubstitute(self, string):
         if len(string) == 0: return ""
-        new_string = ''
         delim = '&'
-        if DEBUG: delim = ' & '
-
-        i = 0
-        while i < len(string):
-            char = string[i]
-
-            if len(new_string.split('\n')[-1]) + 128 > MAX_LINE_LENGTH:
-                new_string = new_string[:-len(delim)] + ' _\n& '
-
-            if i + 1 < len(string):
-                if char == '"' and string[i+1] == '"':
-                    i += 2
-                    new_string += '""""' + delim
-                    continue
-            if char == '"':
-                # Fix improper quote escape
-                new_string += '""""' + delim
-                i += 1
-                continue
-
-            new_string += self.obfuscateChar(char) + delim
-            i += 1
+        if self.debug: delim = ' & '
+
+        # Quotes, escaped or not (fixing improper escapes), become a quote literal,
+        # all other characters get encoded in one batch. Pieces get joined once at
+        # the end, while the length of the line being built is tracked in a running
+        # column counter.
+        units = re.findall(r'""?|[^"]', string)
+        encoded = iter(self.obfuscateChars([x for x in units if x[0] != '"']))
+        pieces = []
+        column = 0
+
+        for unit in units:
+            if column + 128 > MAX_LINE_LENGTH:
+                pieces[-1] = ' _\n& '
+                column = 2
+
+            piece = '""""' if unit[0] == '"' else next(encoded)
+
+            pieces.append(piece)
+            pieces.append(delim)
+            nl = piece.rfind('\n')
+            if nl == -1:
+                column += len(piece) + len(delim)
+            else:
+                column = len(piece) - nl - 1 + len(delim)
 
-        new_string = new_string[:-len(delim)]
+        pieces.pop()
+        new_string = ''.join(pieces)
         if new_string.endswith(' _'): new_string = new_string[:-2]
         return new_string
 
-    def obfuscateStrings(self, useBitShuffler = True):
-        replaces = set()
-        linesSurrounded = set()
-
-        for m in re.finditer(ScriptObfuscator.STRINGS_REGEX, self.output, flags=re.I|re.M):
-            orig_string = m.group(1)
-            string = orig_string[1:-1]
-
-            opening = max(m.span()[0]-500, 0)
-            line_start = opening + self.output[opening:m.span()[0]].rfind('\n') + 1
-            line_stop = m.span()[1] + self.output[m.span()[1]:].find('\n') + 1
-            line = self.output[line_start:line_stop]
-
-            func = re.search(ScriptObfuscator.FUNCTION_PARAMETERS_REGEX, line, re.I)
-            if func:
-                # Syntax error while obfuscating pointer names and libs
-                
-                if line in linesSurrounded: continue
-                # BUG: Surrounding 'Declare PtrSafe Function' with comments is messing 
-                #       up `removeComments` procedure that gets called right after `obfuscateStrings`.
-                #       The avoided-comments list approach is not working by now correctly.
-
-                # if self.garbage_perc > 0:
-                #   varName = randomString(random.randint(8,20))
-                #   varName2 = randomString(random.randint(8,20))
-                #   junk = self.obfuscateString(randomString(random.randint(40,50)))
-                #   junk2 = self.obfuscateString(randomString(random.randint(40,50)))
-                #   garbage = '\'Dim %(varName)s\n\'Set %(varName)s = %(varContents)s\n' % \
-                #   {'varName' : varName, 'varContents' : junk}
-                #   garbage2 = '\'Dim %(varName)s\n\'Set %(varName)s = %(varContents)s\n' % \
-                #   {'varName' : varName2, 'varContents' : junk2}
-
-                #   info("Surrounding Pointer declaration with obfuscated junk")
-                #   dbg("\tJunk to surround:\nREPLACE this:\t{{ %s }}\nWITH this:\t{{ %s }}" % (line, garbage + line + garbage2))
-                #   replaces.add((line, garbage + line + garbage2))
-                #   linesSurrounded.add(line)
-
-                #   self.avoidRemovingTheseComments.extend([x for x in garbage.split('\n') if x])
-                #   self.avoidRemovingTheseComments.extend([x for x in garbage2.split('\n') if x])
+    def canBitShuffle(self, string, useBitShuffler = True):
+        if BitShuffleStringObfuscator.STRING_PADDING_CHAR in string:
+            info("\tPadding character: (%s) has been detected in input string. Have to avoid Bit Shuffle string encoder.", BitShuffleStringObfuscator.STRING_PADDING_CHAR)
+            return False
+
+        return useBitShuffler and len(string) > 5
+
+    def obfuscateLiteral(self, string, shuffled = None):
+        if shuffled is None:
+            return [(ScriptLexer.CODE, self.obfuscateStringBySubstitute(string))]
+
+        new_string = '"%s"' % shuffled
+        if len(new_string) <= 40:
+            new_string = self.obfuscateStringBySubstitute(new_string[1:-1])
+        elif len(new_string) > MAX_LINE_LENGTH:
+            # Literals that could not be hoisted get continued over several lines.
+            new_string = ' & _\n'.join('"%s"' % x for x in splitLiteral(shuffled, LARGE_LITERAL_CHUNK))
+
+        # The deobfuscator's name stays an identifier, so that it gets renamed along its definition.
+        return [
+            (ScriptLexer.IDENTIFIER, self.bitShuffleObfuscator.getDeobfuscatorFuncName()),
+            (ScriptLexer.OPERATOR, '('),
+            (ScriptLexer.CODE, new_string),
+            (ScriptLexer.OPERATOR, ')'),
+        ]
+
+    def obfuscateLargeLiteral(self, varName, string, useBitShuffler = True):
+        # Yields the tokens of statements assigning the literal to varName chunk by chunk,
+        # so that only one chunk is being encoded at a time.
+        useBitShuffler = self.canBitShuffle(string, useBitShuffler)
+        var = (ScriptLexer.IDENTIFIER, varName)
+        assign = (ScriptLexer.OPERATOR, '=')
+        newline = (ScriptLexer.NEWLINE, '\n')
+
+        for tok in ((ScriptLexer.IDENTIFIER, 'Dim'), (ScriptLexer.WHITESPACE, ' '), var, newline):
+            yield tok
+
+        first = True
+        for chunk in splitLiteral(string, LARGE_LITERAL_CHUNK):
+            shuffled = None
+            if useBitShuffler:
+                shuffled = self.bitShuffleObfuscator.obfuscateString(chunk, False)
+
+            if first:
+                yield var
+                yield assign
+            else:
+                for tok in (var, assign, var, (ScriptLexer.OPERATOR, '+')):
+                    yield tok
+            first = False
+
+            for tok in self.obfuscateLiteral(chunk, shuffled):
+                yield tok
+            yield newline
+
+    def parameterRenames(self):
+        # Renames registered by obfuscateStrings() for the whole token stream, for
+        # segments of it to be obfuscated apart yet consistently.
+        renames = {}
+        for line in ScriptLexer.lines(self.tokens):
+            for (kind, text) in line:
+                if (kind == ScriptLexer.IDENTIFIER and text.lower() == 'as') or \
+                    (kind == ScriptLexer.STRING and len(text) > 2 and text.endswith('"')):
+                    self.isAvoidedLine(ScriptLexer.elidedLineText(line), renames)
+                    break
+        return renames
+
+    def isAvoidedLine(self, line, renames):
+        # True if string literals on that line have to be left as they are. Parameters
+        # declared on it get registered in renames.
+        func = re.search(ScriptObfuscator.FUNCTION_PARAMETERS_REGEX, line, flags=re.I)
+        if func:
+            # Syntax error while obfuscating pointer names and libs
+            if func.group(1).lower() not in renames and func.group(1).casefold() not in self.reserved:
+                newfunc = self.names.allocate(4, 12)
+                renames[func.group(1).lower()] = newfunc
+                info("OBFUSCATED DECLARE FUNC:\n\t%s\n\t{{ %s }}\n\t=====>\n\t{{ %s }}\n\t%s\n", '^' * 60, func.group(1), newfunc, '^' * 60)
+
+            # BUG: Surrounding 'Declare PtrSafe Function' with comments is messing 
+            #       up `removeComments` procedure that gets called right after `obfuscateStrings`.
+            #       The avoided-comments list approach is not working by now correctly.
+
+            # if self.garbage_perc > 0:
+            #   varName = randomString(self.random.randint(8,20), self.random)
+            #   varName2 = randomString(self.random.randint(8,20), self.random)
+            #   junk = self.obfuscateString(randomString(self.random.randint(40,50), self.random))
+            #   junk2 = self.obfuscateString(randomString(self.random.randint(40,50), self.random))
+            #   garbage = '\'Dim %(varName)s\n\'Set %(varName)s = %(varContents)s\n' % \
+            #   {'varName' : varName, 'varContents' : junk}
+            #   garbage2 = '\'Dim %(varName)s\n\'Set %(varName)s = %(varContents)s\n' % \
+            #   {'varName' : varName2, 'varContents' : junk2}
+
+            #   info("Surrounding Pointer declaration with obfuscated junk")
+            #   dbg("\tJunk to surround:\nREPLACE this:\t{{ %s }}\nWITH this:\t{{ %s }}" % (line, garbage + line + garbage2))
+            #   replaces.add((line, garbage + line + garbage2))
+            #   linesSurrounded.add(line)
+
+            #   self.avoidRemovingTheseComments.extend([x for x in garbage.split('\n') if x])
+            #   self.avoidRemovingTheseComments.extend([x for x in garbage2.split('\n') if x])
+            return True
+
+        # Const are not to be anyhow obfuscated.
+        return 'const ' in line.lower()
+
+    def startsPlainStatement(self, i):
+        # True if the logical line starting at token i is one that another statement
+        # may be put right before: not an ElseIf, Else or Case branch, a labelled
+        # line or a single-line If.
+        words = []
+        j = i
+        while j < len(self.tokens) and self.tokens[j][0] != ScriptLexer.NEWLINE:
+            (kind, text) = self.tokens[j]
+            if kind == ScriptLexer.CONTINUATION:
+                j += 2
                 continue
-
-            elif line.lstrip().startswith("'"): continue
-
-            exceptionallyAvoidBitShuffler = False
-
-            if 'const ' in line.lower():
-                # Const are not to be anyhow obfuscated.
+            if kind != ScriptLexer.WHITESPACE and kind != ScriptLexer.COMMENT:
+                words.append(text.lower() if kind == ScriptLexer.IDENTIFIER else text)
+            j += 1
+
+        if not words or words[0] in ScriptObfuscator.BRANCH_KEYWORDS:
+            return False
+        if len(words) > 1 and words[1] == ':':
+            return False
+        if words[0] == 'if' and 'then' in words and words[-1] != 'then':
+            return False
+        return True
+
+    def obfuscateStrings(self, useBitShuffler = True, renames = None):
+        # Renames given by the caller are complete already, otherwise they get
+        # registered while looking at the lines.
+        if renames is None:
+            renames = {}
+
+        lineOffsets = ScriptLexer.lineOffsets(self.tokens)
+        lineContexts = {}
+
+        # Line number => True if string literals on that line have to be left as they are.
+        def lineContext(lineNum):
+            if lineNum not in lineContexts:
+                lineContexts[lineNum] = self.isAvoidedLine(ScriptLexer.elidedLineText(
+                    self.tokens[lineOffsets[lineNum]:lineOffsets[lineNum + 1]]), renames)
+            return lineContexts[lineNum]
+
+        # Locate literals to rewrite. Lines holding an 'As' are looked at even without
+        # literals, as they may declare parameters to be renamed.
+        literals = []
+        lineNum = 0
+        for i in range(len(self.tokens)):
+            (kind, text) = self.tokens[i]
+            if kind == ScriptLexer.NEWLINE:
+                lineNum += 1
+
+            elif kind == ScriptLexer.IDENTIFIER and text.lower() == 'as':
+                lineContext(lineNum)
+
+            # Empty and unterminated literals are left as they are.
+            elif kind == ScriptLexer.STRING and len(text) > 2 and text.endswith('"'):
+                if lineContext(lineNum): continue
+                literals.append((i, lineNum, text[1:-1]))
+
+        # Literals too long to fit a line are built up in a variable assigned right before
+        # the statement using them. Their encoding is deferred to the splicing below, so
+        # that it runs one chunk at a time.
+        hoists = {}
+        edits = {}
+        for (i, lineNum, string) in literals:
+            if len(string) <= MAX_LINE_LENGTH: continue
+            start = lineOffsets[lineNum]
+            while lineNum > 0 and self.tokens[lineOffsets[lineNum] - 2][0] == ScriptLexer.CONTINUATION:
+                lineNum -= 1
+                start = lineOffsets[lineNum]
+            if not self.startsPlainStatement(start):
+                info("Large literal (len: %d) cannot be assigned before its statement, continuing it in place.", len(string))
                 continue
-
-            if BitShuffleStringObfuscator.STRING_PADDING_CHAR in string:
-                info("\tPadding character: (%s) has been detected in input string. Have to avoid Bit Shuffle string encoder." % BitShuffleStringObfuscator.STRING_PADDING_CHAR)
-                exceptionallyAvoidBitShuffler = True
-
-            #info("String to obfuscate (context: {{%s}}, len: %d): {{%s}}" % (m.group(0).strip(), len(orig_string), string))
-            
-            if exceptionallyAvoidBitShuffler or not useBitShuffler or len(string) <= 5:
-                new_string = self.obfuscateStringBySubstitute(string)
+            varName = self.names.allocate(8, 12)
+            hoists.setdefault(start, []).append((varName, string))
+            edits[i] = [(ScriptLexer.IDENTIFIER, varName)]
+            info("Large literal (len: %d) will be assigned in chunks to: %s", len(string), varName)
+
+        # Bit shuffle all other eligible literals in one batch.
+        literals = [(i, string) for (i, lineNum, string) in literals if i not in edits]
+        toShuffle = [string for (i, string) in literals if self.canBitShuffle(string, useBitShuffler)]
+        shuffled = dict(zip(toShuffle, self.bitShuffleObfuscator.obfuscateStrings(toShuffle, False)))
+
+        debug = logEnabled(LOG_DEBUG)
+        for (i, string) in literals:
+            edits[i] = self.obfuscateLiteral(string, shuffled.get(string))
+            if debug: dbg("Replacing:\n\t{{ %s }}\n\t=====>\n\t{{ %s }}\n", self.tokens[i][1], ScriptLexer.join(edits[i]))
+
+        # Splice the rewritten literals and renamed parameters in one pass.
+        tokens = []
+        for i in range(len(self.tokens)):
+            tok = self.tokens[i]
+            if i in hoists:
+                for (varName, string) in hoists[i]:
+                    tokens.extend(self.obfuscateLargeLiteral(varName, string, useBitShuffler))
+            if i in edits:
+                tokens.extend(edits[i])
+            elif tok[0] == ScriptLexer.IDENTIFIER and tok[1].lower() in renames \
+                and not ScriptLexer.isMemberAccess(self.tokens, i):
+                tokens.append((ScriptLexer.IDENTIFIER, renames[tok[1].lower()]))
             else:
-                new_string = '"%s"' % self.bitShuffleObfuscator.obfuscateString(string, False)
-                if len(new_string) <= 40:
-                    new_string = self.obfuscateStringBySubstitute(new_string[1:-1])
-                new_string = '%s(%s)' % (self.bitShuffleObfuscator.getDeobfuscatorFuncName(), new_string)
+                tokens.append(tok)
 
-            #info("OBFUSCATED:\n\t%s\n\t{{ %s }}\n\t=====>\n\t{{ %s }}\n\t%s\n" % ('^' * 60, string, new_string, '^' * 60))
+        self.tokens = tokens
 
-            replaces.add((orig_string, new_string))
+        if self.profiler:
+            hoisted = sum(len(x) for x in hoists.values())
+            self.count('literals', len(literals) + hoisted)
+            self.count('shuffled', len(toShuffle))
+            self.count('hoisted', hoisted)
+            self.count('avoided_lines', sum(lineContexts.values()))
+            self.count('parameters', len(renames))
 
-        lines = self.output.split('\n')
-        for i in range(len(lines)):
-            line = lines[i]
-
-            m = re.search(ScriptObfuscator.FUNCTION_PARAMETERS_REGEX, lines[i], flags=re.I|re.M)
-            if m:
-                func = m.group(1)
-                newfunc = randomString(random.randint(4,12))
-                replaces.add((func, newfunc))
-                info("OBFUSCATED DECLARE FUNC:\n\t%s\n\t{{ %s }}\n\t=====>\n\t{{ %s }}\n\t%s\n" % ('^' * 60, func, newfunc, '^' * 60))
+    def obfuscateArrays(self):
+        tokens = []
+        i = 0
+        arrays = 0
+        elements = 0
+        verbose = logEnabled(LOG_VERBOSE)
 
-        for (orig, new) in replaces:
-            dbg("Replacing:\n\t{{ %s }}\n\t=====>\n\t{{ %s }}\n" % (orig, new))
-            self.output = self.output.replace(orig, new) 
+        while i < len(self.tokens):
+            tok = self.tokens[i]
+            i += 1
+            tokens.append(tok)
+            if tok[0] != ScriptLexer.IDENTIFIER or tok[1].lower() != 'array':
+                continue
 
-        self.addDeobfuscator()
+            # Array, optional whitespace, then everything up to the closing parenthesis.
+            j = i
+            while j < len(self.tokens) and self.tokens[j][0] == ScriptLexer.WHITESPACE:
+                j += 1
+            if j >= len(self.tokens) or self.tokens[j] != (ScriptLexer.OPERATOR, '('):
+                continue
+            try:
+                k = self.tokens.index((ScriptLexer.OPERATOR, ')'), j + 1)
+            except ValueError:
+                continue
+            if k == j + 1:
+                continue
 
-    def obfuscateArrays(self):
-        for m in re.finditer(r"\bArray\s*\(([^\)]+?)\)", self.output, flags=re.I|re.M):
-            orig_array = m.group(1)
+            # The whole body gets checked and parsed at once, elements are only
+            # looked at one by one to be encoded.
+            orig_array = ScriptLexer.join(self.tokens[j + 1:k])
             array = orig_array
             array = array.replace('\n', '').replace('\t', '')
-            info("Array to obfuscate: Array(%s, ..., %s)" % (array[:40], array[-40:]))
-            for_nums_allowed = [x for x in string.digits[:]]
-            for_nums_allowed.extend(['a', 'b', 'c', 'd', 'e', 'f', ' ', '-', '_', '&', ','])
-            if all(map(lambda x: x in for_nums_allowed, array)):
+            if verbose: info("Array to obfuscate: Array(%s, ..., %s)", array[:40], array[-40:])
+            if ScriptObfuscator.NUMERIC_ARRAY_CHARS.issuperset(array):
                 # Array of numbers
                 array = array.replace(' ', '').replace('_', '')
                 try:
-                    info("\tLooks like array of numbers.")
-                    new_array = []
+                    if verbose: info("\tLooks like array of numbers.")
                     nums = array.split(',')
-                    for num in nums:
-                        num = num.strip()
-                        new_array.append(ScriptObfuscator.obfuscateNumber(int(num)))
+                    new_array = self.obfuscateNumbers(list(map(int, nums)))
 
                     obfuscated = 'Array(' + ','.join(new_array) + ')'
-                    info("\tObfuscated array: Array(%s, ..., %s)" % (','.join(new_array)[:40], ','.join(new_array)[-40:]))
-                    self.output = re.sub(r"Array\s*\(" + orig_array + r"\)", obfuscated, self.output, flags=re.I | re.M)
+                    if verbose: info("\tObfuscated array: Array(%s, ..., %s)", obfuscated[6:46], obfuscated[-41:-1])
+                    tokens[-1] = (ScriptLexer.CODE, obfuscated)
+                    i = k + 1
+                    arrays += 1
+                    elements += len(new_array)
 
                 except ValueError as e:
-                    info("\tNOPE. This is not an array of numbers. Culprit: ('%s', context: '%s')" % (num, m.group(0)))
+                    if verbose:
+                        num = next(x for x in nums if not re.fullmatch(r'-?[0-9]+', x))
+                        info("\tNOPE. This is not an array of numbers. Culprit: ('%s', context: 'Array(%s)')", num, orig_array)
                     continue
             else:
-                info("\tThis doesn't seems to be array of numbers. Other types not supported at the moment.")
-
-
-    def insertGarbage(self):
-        if self.garbage_perc == 0.0:
-            return
-
-        self.detectFunctionBoundaries()
+                if verbose: info("\tThis doesn't seems to be array of numbers. Other types not supported at the moment.")
 
-        lines = self.output.split('\n')
-        inside_func = False
-        garbages_num = int((self.garbage_perc / 100.0) * len(lines))
-        new_lines = ['' for x in range(len(lines) + garbages_num)]
-        garbage_lines = [random.randint(0, len(new_lines)-1) for x in range(garbages_num)]
+        self.count('arrays', arrays)
+        self.count('elements', elements)
+        self.tokens = tokens
 
-        info('Appending %d garbage lines to the %d lines of input code %s' % \
-            (garbages_num, len(lines), str(garbage_lines)))
 
-        j = 0
-        pos = 0
-        offset = 0
+class ResultCache:
+    # On-disk cache of obfuscation results, addressed by a hash of the input and
+    # of everything else the output depends on. Entries are written to a temporary
+    # file and renamed into place, so concurrent writers never expose partial
+    # ones. Reading an entry touches it, and once the cache outgrows its size
+    # limit the least recently used entries get evicted.
 
-        for i in range(len(new_lines)):
-            if j >= len(lines): break
+    STATS = ('hits', 'misses', 'stores', 'evictions')
+    LOCK_TIMEOUT = 10.0
 
-            inside_func = self.isInsideFunc(pos, offset)
+    def __init__(self, directory, maxSize = 256 * 1024 * 1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.objects = os.path.join(directory, 'objects')
+        self.statsFile = os.path.join(directory, 'stats.json')
+        self.lockFile = os.path.join(directory, 'lock')
+        self.stats = dict.fromkeys(ResultCache.STATS, 0)
+        os.makedirs(self.objects, exist_ok = True)
 
-            if i in garbage_lines:
-                if i > 0 and (\
-                    (' _' in new_lines[i - 1].rstrip()[-10:]) or \
-                    (' _' in new_lines[i - 2].rstrip()[-10:]) or \
-                    ('&' in lines[j].lstrip()[:5]) \
-                ):
-                    # Avoid inserting garbage that could break line continuations
+    @staticmethod
+    def key(contents, settings, seed = None):
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'version' : VERSION,
+            'settings' : settings,
+            'seed' : seed,
+        }, sort_keys = True).encode())
+        h.update(b'\0')
+        h.update(contents.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.objects, key[:2], key[2:])
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding = 'utf-8', newline = '') as f:
+                output = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return output
+
+    def put(self, key, output):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        (fd, tmp) = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding = 'utf-8', newline = '') as f:
+                f.write(output)
+            size = os.path.getsize(tmp)
+            try:
+                # An entry being replaced no longer takes up its own size.
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        self.stats['stores'] += 1
+        with self.locked():
+            totals = self.readStats()
+            totals['size'] += size
+            if totals['size'] > self.maxSize:
+                totals['size'] = self.evict()
+            self.writeStats(totals)
+
+    def evict(self):
+        # Drops least recently used entries until the cache fits its size limit,
+        # returns the size left as counted over the entries on disk, which also
+        # corrects the running total for entries removed by anyone else.
+        entries = []
+        for (root, dirs, files) in os.walk(self.objects):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
                     continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        size = sum(x[1] for x in entries)
+        for (mtime, entrySize, path) in entries:
+            if size <= self.maxSize: break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entrySize
+            self.stats['evictions'] += 1
+            dbg("Evicted cache entry: %s", path)
+        return size
+
+    @contextlib.contextmanager
+    def locked(self):
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(self.lockFile, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                # A lock left behind by a killed process gets broken.
+                try:
+                    if time.time() - os.path.getmtime(self.lockFile) > ResultCache.LOCK_TIMEOUT:
+                        os.remove(self.lockFile)
+                except OSError:
+                    pass
+                if time.time() - start > ResultCache.LOCK_TIMEOUT * 2:
+                    raise TimeoutError('Could not lock the cache: %s' % self.lockFile)
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(self.lockFile)
+            except OSError:
+                pass
+
+    def readStats(self):
+        totals = dict.fromkeys(ResultCache.STATS + ('size',), 0)
+        try:
+            with open(self.statsFile, 'r') as f:
+                totals.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return totals
+
+    def writeStats(self, totals):
+        for name in ResultCache.STATS:
+            totals[name] += self.stats[name]
+            self.stats[name] = 0
+        tmp = self.statsFile + '.%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(totals, f, indent = 2)
+        os.replace(tmp, self.statsFile)
+
+    def flush(self):
+        # Adds counters of this instance to the totals kept in the cache directory.
+        if any(self.stats.values()):
+            with self.locked():
+                self.writeStats(self.readStats())
+
+    def report(self):
+        totals = self.readStats()
+        for name in ResultCache.STATS:
+            totals[name] += self.stats[name]
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_ratio'] = (totals['hits'] / float(lookups)) if lookups else 0.0
+        return totals
+
+
+def obfuscateWithCache(obfuscator, contents, cache = None, seed = None):
+    # Returns (output, True) when the output was taken from the cache. Without
+    # a seed every run gives different output, so there is nothing to reuse.
+    if not cache or seed is None:
+        return (obfuscateContents(obfuscator, contents), False)
+
+    settings = obfuscator.settings()
+    settings['jobs'] = obfuscator.jobs
+    key = ResultCache.key(contents, settings, seed)
+    output = cache.get(key)
+    if output is not None:
+        info("Cache hit: %s", key)
+        return (output, True)
+
+    output = obfuscateContents(obfuscator, contents)
+    cache.put(key, output)
+    return (output, False)
+
+class Result:
+    # What obfuscate() returns: the obfuscated code, the names that got renamed
+    # (lowercase original name to the new one), statistics of the run with every
+    # pass' record as PassProfiler reports them, and the log.
+    __slots__ = ('output', 'renames', 'stats', 'log')
+
+    def __init__(self, output, renames, stats, log):
+        self.output = output
+        self.renames = renames
+        self.stats = stats
+        self.log = log
+
+# Options obfuscate() takes, with their defaults: ScriptObfuscator's arguments and
+# the level of the log captured into the result.
+OPTIONS = {
+    'normalize_only' : False,
+    'reserved_words' : (),
+    'garbage_perc' : 12.0,
+    'min_var_length' : 5,
+    'jobs' : 1,
+    'seed' : None,
+    'passes' : None,
+    'debug' : False,
+    'log_level' : LOG_NORMAL,
+}
 
-                comment = True
-                if inside_func:
-                    comment = False
-
-                varName = randomString(random.randint(4,12))
-                varContents = self.obfuscateString(randomString(random.randint(10,30)))
-                garbage = ''
-                if comment:
-                    garbage = '\'Dim %(varName)s As String\n\'%(varName)s = %(varContents)s' % \
-                    {'varName' : varName, 'varContents' : varContents}
-                else:
-                    garbage = 'Dim %(varName)s As String\n%(varName)s = %(varContents)s' % \
-                    {'varName' : varName, 'varContents' : varContents}
-
-                # TODO:
-                new_lines[i] = garbage
-                offset += 2
-            else:
-                new_lines[i] = lines[j]
-                pos += len(lines[j]) + 1
-                j += 1
-
-        self.output = '\n'.join(new_lines)
-
-
-def classifyFileAndExtractContents(contents):
-    # Simple decision tree
-    htmlOrHtaFile = (
-        '<html', '</html>', '<script', '</script>'
-    )
-
-    allMarkers = True
-    for a in htmlOrHtaFile:
-        if a not in contents.lower():
-            allMarkers = False
+def obfuscate(text, options = None):
+    # Library entry point, safe to call from many threads or processes at once:
+    # it depends on nothing but its arguments, and logs into the result instead
+    # of stderr.
+    options = dict(OPTIONS, **(options or {}))
+    unknown = sorted(set(options) - set(OPTIONS))
+    if unknown:
+        raise ValueError('Unknown option: %s' % ', '.join(unknown))
+
+    level = options.pop('log_level')
+    profiler = PassProfiler()
+    with logTo(io.StringIO(), level, False) as stream:
+        obfuscator = ScriptObfuscator(profiler = profiler, **options)
+        output = obfuscator.obfuscate(text)
+
+    stats = profiler.report()
+    stats['input_size'] = len(text)
+    stats['output_size'] = len(output)
+    return Result(output, dict(obfuscator.renames), stats, stream.getvalue())
+
+
+# Outside of scripts: HTML comments (skipped whole) and opening script tags with
+# their attributes. Inside of a script, the tag closing it.
+SCRIPT_OPEN_REGEX = re.compile(r'<!--.*?-->|<script\b([^>]*)>', re.I | re.S)
+SCRIPT_CLOSE_REGEX = re.compile(r'</script\s*>', re.I)
+VBSCRIPT_ATTRIBUTES_REGEX = re.compile(r'\b(?:language|type)\s*=\s*["\']?(?:text/)?vbs(?:cript)?(?![\w.])', re.I)
+
+# Beginning of an HTML/HTA document, possibly after a byte order mark.
+DOCUMENT_START_REGEX = re.compile(r'\ufeff?\s*<')
+
+# Code in the document outside of script blocks: event handler attributes and
+# vbscript: links.
+EVENT_HANDLERS_REGEX = re.compile(r'\bon\w+\s*=\s*(?:"([^"]*)"|\'([^\']*)\')|vbscript:([^"\'>]*)', re.I)
+
+def findScriptBlocks(contents):
+    # Offsets (start, stop) of the code of every VBScript block of an HTML/HTA
+    # document, found in one pass over it. Scripts in other languages, encoded
+    # ones and commented out ones are skipped.
+    blocks = []
+    pos = 0
+    while True:
+        m = SCRIPT_OPEN_REGEX.search(contents, pos)
+        if not m:
             break
+        pos = m.end()
+        if m.group(1) is None:
+            continue
 
-    if allMarkers:
-        ok("File has been classified as HTML/HTA or containing <script> to be extracted.")
-        m = re.search(r"\<script[^\>]+>(.*)</script>", contents, flags=re.I|re.M|re.S)
-        if m:
-            return m.group(1)
+        close = SCRIPT_CLOSE_REGEX.search(contents, pos)
+        if not close:
+            break
+        if VBSCRIPT_ATTRIBUTES_REGEX.search(m.group(1)):
+            blocks.append((pos, close.start()))
+        pos = close.end()
+
+    return blocks
+
+def obfuscateContents(obfuscator, contents, stream = None):
+    # HTML/HTA documents (anything starting with a tag, which Visual Basic code
+    # never does) get their VBScript blocks obfuscated, anything else is code.
+    # Given a stream, the output gets written there and its length returned. A
+    # byte order mark read along with the file stays in front of the document.
+    if not DOCUMENT_START_REGEX.match(contents):
+        return obfuscator.obfuscate(contents, stream)
+
+    blocks = findScriptBlocks(contents)
+    if not blocks:
+        err('No VBScript blocks found in the HTML/HTA document, leaving it as it is.')
+        if stream is not None:
+            stream.write(contents)
+            return len(contents)
+        return contents
+
+    ok('File has been classified as HTML/HTA with %d VBScript blocks to obfuscate.' % len(blocks))
+    return obfuscateDocument(obfuscator, contents, blocks, stream)
+
+def obfuscateDocument(obfuscator, contents, blocks, stream = None):
+    # Every block gets obfuscated on its own, drawing its seed from the obfuscator,
+    # and spliced back in between the untouched rest of the document. Once loaded
+    # the blocks share one namespace, hence names used by more than one block or
+    # by event handlers of the document are left alone, and new names come from
+    # one allocator knowing the identifiers of all the blocks. For the same reason
+    # the deobfuscation routines get added once, to the first block calling them.
+    outside = [contents[a:b] for (a, b) in zip([0] + [x[1] for x in blocks], [x[0] for x in blocks] + [len(contents)])]
+
+    counts = collections.Counter()
+    for (start, stop) in blocks:
+        names = set(text.casefold() for (kind, text) in ScriptLexer.tokenize(contents[start:stop]) if kind == ScriptLexer.IDENTIFIER)
+        obfuscator.names.reserve(names)
+        counts.update(names)
+
+    shared = set(name for (name, count) in counts.items() if count > 1)
+    for part in outside:
+        for m in EVENT_HANDLERS_REGEX.finditer(part):
+            shared.update(x.casefold() for x in re.findall(r'\w+', ''.join(filter(None, m.groups()))))
+
+    settings = obfuscator.settings()
+    settings['reserved_words'] = settings['reserved_words'] + sorted(shared)
+    settings['passes'] = [x for x in settings['passes'] if x != 'addDeobfuscator']
+
+    routine = (ScriptLexer.IDENTIFIER, BitShuffleStringObfuscator.DEOBFUSCATE_ROUTINE_NAME)
+    outputs = []
+    callers = []
+    for i in range(len(blocks)):
+        (start, stop) = blocks[i]
+        info('Obfuscating script block %d of %d (%d bytes).', i + 1, len(blocks), stop - start)
+        block = ScriptObfuscator(jobs = obfuscator.jobs, seed = obfuscator.random.getrandbits(64), \
+            profiler = obfuscator.profiler, names = obfuscator.names, **settings)
+        outputs.append(block.obfuscate(contents[start:stop]))
+        if routine in block.tokens:
+            callers.append((i, block))
+
+    if callers and 'addDeobfuscator' in obfuscator.passes:
+        # The routines on their own, renamed and stripped like the blocks are, with
+        # the calls of every block following the routine's new name.
+        helper = ScriptObfuscator(seed = obfuscator.random.getrandbits(64), profiler = obfuscator.profiler, \
+            names = obfuscator.names, **dict(settings, passes = [x for x in settings['passes'] if x in ScriptObfuscator.DEOBFUSCATOR_PASSES]))
+        info('Appending bit shuffle string deobfuscation routines to script block %d.', callers[0][0] + 1)
+        code = helper.obfuscate(helper.bitShuffleObfuscator.getDeobfuscatorCode())
+        name = helper.renames.get(routine[1].lower())
+        if name:
+            for (i, block) in callers:
+                block.renameIdentifiers({routine[1].lower() : name})
+                outputs[i] = ScriptLexer.join(block.tokens)
+        outputs[callers[0][0]] += '\n' + code
+
+    pieces = [outside[0]]
+    for i in range(len(blocks)):
+        pieces.append('\n' + outputs[i] + '\n')
+        pieces.append(outside[i + 1])
+
+    if stream is None:
+        return ''.join(pieces)
+    for piece in pieces:
+        stream.write(piece)
+    return sum(map(len, pieces))
+
+def collectInputs(paths, manifest = ''):
+    # Expands directories, glob patterns and manifest entries into a list of
+    # (input file, output path relative to the output directory) tuples, along
+    # with the entries that do not exist or match no file.
+    entries = list(paths)
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                entries.append(line if os.path.isabs(line) else os.path.join(base, line))
+
+    inputs = []
+    missing = []
+    for entry in entries:
+        if os.path.isdir(entry):
+            for root, dirs, files in os.walk(entry):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(INPUT_EXTENSIONS):
+                        path = os.path.join(root, name)
+                        inputs.append((path, os.path.relpath(path, entry)))
+        elif os.path.isfile(entry):
+            inputs.append((entry, os.path.basename(entry)))
         else:
-            err("Although it was not possible to extract script contents. Proceeding with raw")
-            return contents
+            matches = sorted(x for x in glob.glob(entry, recursive = True) if os.path.isfile(x))
+            if not matches:
+                err('Input does not exist or matches no file: %s' % entry)
+                missing.append(entry)
+            for path in matches:
+                inputs.append((path, os.path.basename(path)))
+
+    # Different inputs with the same name would overwrite each other's output.
+    seen = set()
+    taken = set()
+    unique = []
+    for (path, rel) in inputs:
+        if os.path.abspath(path) in seen: continue
+        seen.add(os.path.abspath(path))
+        (stem, ext) = os.path.splitext(rel)
+        num = 1
+        while rel in taken:
+            rel = '%s-%d%s' % (stem, num, ext)
+            num += 1
+        taken.add(rel)
+        unique.append((path, rel))
+
+    return (unique, missing)
+
+def obfuscateFile(job):
+    # Batch worker: obfuscates one file, logging into a buffer of its own that
+    # gets saved next to the output file.
+    (inputFile, outputFile, options) = job
+
+    result = {
+        'input' : inputFile,
+        'output' : outputFile,
+        'status' : 'ok',
+        'input_size' : 0,
+        'output_size' : 0,
+        'time' : 0.0,
+        'cpu_time' : 0.0,
+        'cached' : False,
+    }
 
-    return contents
+    with logTo(io.StringIO(), optionsLogLevel(options), False) as stream:
+        start = time.perf_counter()
+        cpuStart = time.process_time()
+
+        try:
+            with open(inputFile, 'r') as f:
+                contents = f.read()
+            result['input_size'] = len(contents)
+
+            # Every file gets a seed of its own, for outputs not to depend on the order
+            # workers happen to pick files up in.
+            seed = None
+            if options['seed'] is not None:
+                seed = '%s:%s' % (options['seed'], os.path.relpath(outputFile, options['output_dir']))
+
+            obfuscator = ScriptObfuscator(
+                options['normalize_only'], \
+                options['custom_reserved_words'], \
+                options['garbage_perc'], \
+                options['min_var_length'], \
+                seed = seed, \
+                profiler = PassProfiler(options['cprofile']) if options['profile'] else None, \
+                passes = options['passes'], \
+                debug = options['debug'])
+
+            cache = ResultCache(options['cache'], options['cache_size'] * 1024 * 1024) if options['cache'] else None
+            (obfuscated, result['cached']) = obfuscateWithCache(obfuscator, contents, cache, seed)
+            if cache:
+                cache.flush()
+            if obfuscator.profiler and not result['cached']:
+                os.makedirs(os.path.dirname(outputFile) or '.', exist_ok = True)
+                saveProfile(obfuscator.profiler, outputFile)
+                result['profile'] = outputFile + '.profile.json'
+
+            os.makedirs(os.path.dirname(outputFile) or '.', exist_ok = True)
+            with open(outputFile, 'w') as f:
+                f.write(obfuscated)
+            result['output_size'] = len(obfuscated)
+
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+            err('Could not obfuscate %s: %s' % (inputFile, result['error']))
+
+        result['time'] = time.perf_counter() - start
+        result['cpu_time'] = time.process_time() - cpuStart
+
+    log = stream.getvalue()
+    if log:
+        result['log'] = outputFile + '.log'
+        with open(result['log'], 'w') as f:
+            f.write(log)
+
+    return result
+
+def obfuscateSegmentStrings(job):
+    # Procedure parallelism, first round: strings of one segment, returning it
+    # together with its rename candidates and its log. Strings are
+    # left alone when no renames are given (the deobfuscator routine).
+    (settings, seed, tokens, renames, names, (level, colors)) = job
+    with logTo(io.StringIO(), level, colors) as stream:
+        obfuscator = ScriptObfuscator(seed = seed, **settings)
+        obfuscator.tokens = tokens
+        obfuscator.reserveIdentifiers(tokens)
+        obfuscator.names.supply(names, 8, 12)
+        if renames is not None and 'obfuscateStrings' in obfuscator.passes:
+            obfuscator.obfuscateStrings(renames = renames)
+        candidates = None
+        if 'randomizeVariablesAndFunctions' in obfuscator.passes:
+            (candidates, identifiers) = obfuscator.discoverNames()
+    return (obfuscator.tokens, candidates, stream.getvalue())
+
+def obfuscateSegmentNames(job):
+    # Procedure parallelism, second round: renames chosen for the whole file,
+    # arrays, then comments and indents in one walk over the lines of one segment.
+    (settings, seed, tokens, replacedAlready, (level, colors)) = job
+    with logTo(io.StringIO(), level, colors) as stream:
+        obfuscator = ScriptObfuscator(seed = seed, **settings)
+        obfuscator.tokens = tokens
+        if replacedAlready:
+            obfuscator.renameIdentifiers(replacedAlready)
+        if 'obfuscateArrays' in obfuscator.passes:
+            obfuscator.obfuscateArrays()
+        functions = []
+        if 'removeComments' in obfuscator.passes:
+            functions.append(obfuscator.removeLineComment)
+        if 'removeIndents' in obfuscator.passes:
+            functions.append(obfuscator.removeLineIndents)
+        if functions:
+            obfuscator.tokens = obfuscator.mapLines(functions)
+    return (obfuscator.tokens, stream.getvalue())
+
+def runBatch(inputs, outputDir, jobs = 0, summaryFile = '', missing = ()):
+    # Inputs that were missing count as failed files of the batch.
+    options = dict(config)
+    options['colors'] = False
+
+    tasks = [(path, os.path.join(outputDir, rel), options) for (path, rel) in inputs]
+    jobs = min(jobs or os.cpu_count() or 1, max(len(tasks), 1))
+    ok('Obfuscating %d files with %d workers into: %s' % (len(tasks), jobs, outputDir))
+
+    start = time.perf_counter()
+    results = []
+    if jobs == 1:
+        mapped = map(obfuscateFile, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        mapped = pool.imap_unordered(obfuscateFile, tasks)
 
-def randomString(len):
+    for result in mapped:
+        results.append(result)
+        if result['status'] == 'ok':
+            ok('[%d/%d] %s (%d => %d bytes, %.2fs%s)' % (len(results), len(tasks), result['input'], result['input_size'], result['output_size'], result['time'], ', cached' if result['cached'] else ''))
+        else:
+            err('[%d/%d] %s: %s' % (len(results), len(tasks), result['input'], result['error']))
+
+    if jobs != 1:
+        pool.close()
+        pool.join()
+
+    for entry in missing:
+        results.append({
+            'input' : entry,
+            'output' : None,
+            'status' : 'error',
+            'error' : 'Input does not exist or matches no file',
+            'input_size' : 0,
+            'output_size' : 0,
+            'time' : 0.0,
+            'cpu_time' : 0.0,
+            'cached' : False,
+        })
+
+    results.sort(key = lambda x: x['input'])
+    summary = {
+        'files' : results,
+        'total' : len(results),
+        'failed' : len([x for x in results if x['status'] != 'ok']),
+        'cached' : len([x for x in results if x['cached']]),
+        'input_size' : sum(x['input_size'] for x in results),
+        'output_size' : sum(x['output_size'] for x in results),
+        'time' : time.perf_counter() - start,
+        'jobs' : jobs,
+    }
+
+    summaryFile = summaryFile or os.path.join(outputDir, 'summary.json')
+    os.makedirs(os.path.dirname(summaryFile) or '.', exist_ok = True)
+    with open(summaryFile, 'w') as f:
+        json.dump(summary, f, indent = 2)
+
+    ok('Done: %d files, %d failed, %.2fs. Summary written to: %s' % (summary['total'], summary['failed'], summary['time'], summaryFile))
+    return summary['failed'] == 0
+
+def saveProfile(profiler, output = ''):
+    # Next to the output file if there is one, to the log otherwise.
+    report = profiler.report()
+    if output:
+        with open(output + '.profile.json', 'w') as f:
+            json.dump(report, f, indent = 2)
+        if profiler.profile:
+            profiler.dumpStats(output + '.pstats')
+        return
+
+    # Asked for explicitly, hence written even when quiet.
+    stream = logSink()
+    stream.write(json.dumps(report, indent = 2) + '\n')
+    if profiler.profile:
+        profiler.printStats(stream)
+
+def reportCacheStats(cache):
+    stats = cache.report()
+    ok('Cache %s: %d hits, %d misses (%.1f%% hit ratio), %d stores, %d evictions, %.1f MB' % \
+        (cache.directory, stats['hits'], stats['misses'], stats['hit_ratio'] * 100.0, \
+        stats['stores'], stats['evictions'], stats['size'] / 1024.0 / 1024.0))
+
+class ObfuscationServer:
+    # Keeps a pool of worker processes warm for obfuscate() jobs coming in over
+    # HTTP. At most workers + queueSize jobs get accepted at once, the ones above
+    # that are turned down for clients to back off and retry later. Latencies of
+    # the last LATENCY_WINDOW jobs are kept for percentiles and recent throughput.
+
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, workers = 1, queueSize = 64):
+        self.workers = workers
+        self.queueSize = queueSize
+        self.pool = multiprocessing.Pool(workers)
+        self.slots = threading.BoundedSemaphore(workers + queueSize)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = collections.deque(maxlen = ObfuscationServer.LATENCY_WINDOW)
+        self.counters = {
+            'accepted' : 0,
+            'completed' : 0,
+            'failed' : 0,
+            'rejected' : 0,
+            'in_flight' : 0,
+            'bytes_in' : 0,
+            'bytes_out' : 0,
+        }
+
+    def bump(self, **counts):
+        with self.lock:
+            for (name, value) in counts.items():
+                self.counters[name] += value
+
+    def submit(self, text, options):
+        # Returns the Result of the job, None when there was no room for it. Jobs
+        # run one procedure at a time, the server's workers already running them
+        # side by side.
+        if not self.slots.acquire(blocking = False):
+            self.bump(rejected = 1)
+            return None
+
+        options = dict(options, jobs = 1)
+        self.bump(accepted = 1, in_flight = 1, bytes_in = len(text))
+        start = time.perf_counter()
+        try:
+            result = self.pool.apply_async(obfuscate, (text, options)).get()
+        except Exception:
+            self.bump(failed = 1)
+            raise
+        finally:
+            self.bump(in_flight = -1)
+            self.slots.release()
+
+        with self.lock:
+            self.counters['completed'] += 1
+            self.counters['bytes_out'] += len(result.output)
+            self.finished.append((time.time(), time.perf_counter() - start))
+        return result
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            finished = list(self.finished)
+
+        now = time.time()
+        stats['workers'] = self.workers
+        stats['queue_size'] = self.queueSize
+        stats['queued'] = max(stats['in_flight'] - self.workers, 0)
+        stats['uptime'] = now - self.started
+        stats['jobs_per_second'] = stats['completed'] / max(stats['uptime'], 1e-9)
+        stats['recent_jobs_per_second'] = len(finished) / max(now - finished[0][0], 1e-9) if len(finished) > 1 else 0.0
+
+        latencies = sorted(x[1] for x in finished)
+        percentile = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else 0.0
+        stats['latency'] = {
+            'mean' : sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50' : percentile(0.50),
+            'p95' : percentile(0.95),
+            'p99' : percentile(0.99),
+            'max' : latencies[-1] if latencies else 0.0,
+        }
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class ObfuscationRequestHandler(http.server.BaseHTTPRequestHandler):
+    # POST /obfuscate takes {"code": ..., "options": {...}} and answers with the
+    # Result as JSON, GET /stats answers with the server's counters.
+
+    server_version = 'VisualBasicObfuscator/' + VERSION
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.reply(404, {'error' : 'Not found: %s' % self.path})
+        self.reply(200, self.server.obfuscator.stats())
+
+    def do_POST(self):
+        if self.path != '/obfuscate':
+            return self.reply(404, {'error' : 'Not found: %s' % self.path})
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            (code, options) = (job['code'], dict(job.get('options') or {}))
+            if not isinstance(code, str):
+                raise TypeError('code is not a string')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self.reply(400, {'error' : 'Malformed job: %s' % e})
+
+        try:
+            result = self.server.obfuscator.submit(code, options)
+        except (ValueError, TypeError) as e:
+            return self.reply(400, {'error' : str(e)})
+        except Exception as e:
+            return self.reply(500, {'error' : '%s: %s' % (e.__class__.__name__, e)})
+
+        if result is None:
+            return self.reply(503, {'error' : 'Queue full'}, [('Retry-After', '1')])
+
+        self.reply(200, {
+            'output' : result.output,
+            'renames' : result.renames,
+            'stats' : result.stats,
+            'log' : result.log,
+        })
+
+    def reply(self, status, body, headers = ()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        info('%s', format % args)
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def parseServerAddress(address):
+    # Either unix:PATH or [HOST]:PORT, HOST defaulting to localhost.
+    if address.startswith('unix:'):
+        return (address[len('unix:'):], None)
+    (host, sep, port) = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def serve(address, workers = 0, queueSize = 64):
+    (host, port) = parseServerAddress(address)
+    workers = workers or os.cpu_count() or 1
+
+    obfuscator = ObfuscationServer(workers, queueSize)
+    try:
+        if port is None:
+            if os.path.exists(host) and stat.S_ISSOCK(os.stat(host).st_mode):
+                os.unlink(host)
+            server = ThreadingUnixHTTPServer(host, ObfuscationRequestHandler)
+        else:
+            server = http.server.ThreadingHTTPServer((host, port), ObfuscationRequestHandler)
+        server.obfuscator = obfuscator
+
+        ok('Serving on %s with %d workers, up to %d jobs queued.' % (address, workers, queueSize))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        if port is None:
+            os.unlink(host)
+    finally:
+        obfuscator.close()
+
+    ok('Served %(completed)d jobs, %(failed)d failed, %(rejected)d rejected.' % obfuscator.stats())
+    return True
 
-    rnd = ''.join(random.choice(
+def iterChunks(parts, size):
+    # Yields size-long pieces of the concatenation of parts, without concatenating them.
+    pending = ''
+    for part in parts:
+        pos = 0
+        if pending:
+            pos = size - len(pending)
+            pending += part[:pos]
+            if len(pending) < size:
+                continue
+            yield pending
+            pending = ''
+
+        while len(part) - pos >= size:
+            yield part[pos:pos + size]
+            pos += size
+        pending = part[pos:]
+
+    if pending:
+        yield pending
+
+def splitLiteral(string, size):
+    # Yields consecutive pieces of a literal's contents, never splitting a "" escape.
+    pos = 0
+    while pos < len(string):
+        stop = min(pos + size, len(string))
+        quotes = 0
+        while stop - quotes > pos and string[stop - quotes - 1] == '"':
+            quotes += 1
+        if quotes % 2 and stop < len(string):
+            stop += 1
+        yield string[pos:stop]
+        pos = stop
+
+def randomString(len, rng = random):
+
+    rnd = ''.join(rng.choice(
         string.ascii_letters + string.digits
     ) for _ in range(len))
 
     if rnd[0] in string.digits:
-        rnd = random.choice(string.ascii_letters) + rnd
+        rnd = rng.choice(string.ascii_letters) + rnd
 
     return rnd
 
+def makeRandom(seed = None):
+    if isinstance(seed, random.Random):
+        return seed
+    return random.Random(seed)
+
 def parse_options(argv):
     global config
     args = None
@@ -1022,14 +2839,29 @@ def parse_options(argv):
 
     group = parser.add_mutually_exclusive_group()
     group2 = parser.add_mutually_exclusive_group()
-    parser.add_argument("input_file", help="Visual Basic script to be obfuscated.")
+    parser.add_argument("input_file", nargs='*', help="Visual Basic script to be obfuscated. In batch mode also directories and glob patterns, any number of them.")
     parser.add_argument("-o", "--output", help="Output file. Default: stdout", default='')
+    parser.add_argument("-O", "--output-dir", dest="output_dir", help="Batch mode: write one obfuscated file per input into that directory.", default='')
+    parser.add_argument("-M", "--manifest", help="Batch mode: file listing inputs, one per line.", default='')
+    parser.add_argument("-j", "--jobs", help="Number of worker processes, obfuscating files in batch mode (default: number of CPUs) or procedures of the single input file otherwise (default: 1).", default=0, type=int)
+    parser.add_argument("-s", "--seed", help="Seed of the random generator, to get the same output for the same input again.", default=None, type=int)
+    parser.add_argument("--cache", help="Directory of a cache of obfuscated outputs, reused for the same input, options and seed.", default='')
+    parser.add_argument("--cache-size", dest="cache_size", help="Size limit of the cache in megabytes, least recently used outputs get evicted above it. Default: 256.", default=config['cache_size'], type=int)
+    parser.add_argument("--cache-stats", dest="cache_stats", help="Report cache hits and misses. Without input files, only prints them.", action='store_true')
+    parser.add_argument("--profile", help="Record time, CPU time, sizes and counters of every pass as JSON, into OUTPUT.profile.json (stderr when writing to stdout).", action='store_true')
+    parser.add_argument("--cprofile", help="Run under cProfile as well, dumping pstats into OUTPUT.pstats (top of the stats to stderr when writing to stdout).", action='store_true')
+    parser.add_argument("--serve", metavar="ADDRESS", help="Server mode: obfuscate jobs POSTed as JSON to /obfuscate over HTTP, on [HOST]:PORT or unix:PATH, with -j worker processes (default: number of CPUs). GET /stats reports the server's counters.", default='')
+    parser.add_argument("--queue-size", dest="queue_size", help="Server mode: jobs accepted above the number of workers, more get turned down with 503. Default: 64.", default=config['queue_size'], type=int)
+    parser.add_argument("-S", "--summary", help="Batch mode: where to write the JSON summary. Default: OUTPUT_DIR/summary.json", default='')
+    parser.add_argument("-P", "--passes", help="Comma-separated passes to run, in the pipeline's order whatever order they are given in. Default: all. Known: %s." % ', '.join('%s (%s)' % (p.option, p.help) for p in ScriptObfuscator.PASSES), default='')
+    parser.add_argument("-X", "--skip", help="Comma-separated passes not to run.", default='')
     group2.add_argument("-N", "--normalize", dest="normalize_only", help="Don't perform obfuscation, do only code normalization (like long strings transformation).", action='store_true')
     group2.add_argument("-g", "--garbage", help="Percent of garbage to append to the obfuscated code. Default: 12%%.", default=config['garbage_perc'], type=float)
     group2.add_argument("-G", "--no-garbage", dest="nogarbage", help="Don't append any garbage.", action='store_true')
     group2.add_argument("-C", "--no-colors", dest="nocolors", help="Dont use colors.", action='store_true')
     parser.add_argument("-m", "--min-var-len", dest='min_var_len', help="Minimum length of variable to include in name obfuscation. Too short value may break the original script. Default: 5.", default=config['min_var_length'], type=int)
     parser.add_argument("-r", "--reserved", action='append', help='Reserved word/name that should not be obfuscated (in case some name has to be in original script cause it may break it otherwise). Repeat the option for more words.')
+    parser.add_argument("-R", "--reserved-file", dest="reserved_files", action='append', metavar='FILE', help="File of reserved words/names, one per line, '#' starting comments. Repeat the option for more files. Visual Basic keywords and intrinsic functions are always reserved.")
     group.add_argument("-v", "--verbose", help="Verbose output.", action="store_true")
     group.add_argument("-d", "--debug", help="Debug output.", action="store_true")
     group.add_argument("-q", "--quiet", help="No unnecessary output.", action="store_true")
@@ -1040,32 +2872,86 @@ def parse_options(argv):
         config['verbose'] = True
 
     if args.debug:
-        global DEBUG
         config['verbose'] = True
-        DEBUG = True
+        config['debug'] = True
 
     if not args:
         parser.print_help()
 
-    if not os.path.isfile(args.input_file):
+    if args.jobs < 0:
+        err('Number of jobs must not be negative!')
+        return False
+    config['jobs'] = args.jobs
+
+    if args.cache_size <= 0:
+        err('Cache size must be greater than 0!')
+        return False
+    if args.cache_stats and not args.cache:
+        err('Cache statistics need a --cache directory!')
+        return False
+    config['seed'] = args.seed
+    config['cache'] = args.cache
+    config['cache_size'] = args.cache_size
+    config['cache_stats'] = args.cache_stats
+    if args.cache and args.seed is None:
+        info('Obfuscated outputs get cached only when a --seed is given.')
+    config['profile'] = args.profile or args.cprofile
+
+    if args.passes or args.skip:
+        try:
+            passes = ScriptObfuscator.passNames(filter(None, args.passes.split(',')) if args.passes else None)
+            skip = ScriptObfuscator.passNames(filter(None, args.skip.split(',')))
+        except ValueError as e:
+            err('%s!' % e)
+            return False
+        config['passes'] = [x for x in passes if x not in skip]
+    config['cprofile'] = args.cprofile
+
+    if args.serve:
+        if args.input_file or args.output_dir or args.manifest or args.output:
+            err('Server mode takes its inputs from clients, no input or output files can be given!')
+            return False
+        try:
+            parseServerAddress(args.serve)
+        except ValueError:
+            err('Server address must be [HOST]:PORT or unix:PATH!')
+            return False
+        if args.queue_size < 0:
+            err('Queue size must not be negative!')
+            return False
+        config['serve'] = args.serve
+        config['queue_size'] = args.queue_size
+
+    elif args.output_dir:
+        if args.output:
+            err('Batch mode writes into the output directory, -o cannot be used with it!')
+            return False
+        if not args.input_file and not args.manifest:
+            err('No inputs given!')
+            return False
+        config['inputs'] = args.input_file
+        config['manifest'] = args.manifest
+        config['output_dir'] = args.output_dir
+        config['summary'] = args.summary
+
+    elif args.cache_stats and not args.input_file and not args.manifest:
+        pass
+
+    elif len(args.input_file) != 1 or args.manifest:
+        err('Exactly one input file is expected, use --output-dir to obfuscate many of them!')
+        return False
+
+    elif not os.path.isfile(args.input_file[0]):
         err('Input file does not exist!')
         return False
     else:
-        config['file'] = args.input_file
+        config['file'] = args.input_file[0]
 
     if args.output:
         config['output'] = args.output
 
     if args.nocolors:
         config['colors'] = False
-        bcolors.HEADER = ''
-        bcolors.OKBLUE = ''
-        bcolors.OKGREEN = ''
-        bcolors.WARNING = ''
-        bcolors.FAIL = ''
-        bcolors.ENDC = ''
-        bcolors.BOLD = ''
-        bcolors.UNDERLINE = ''
 
     if args.normalize_only:
         config['normalize_only'] = args.normalize_only
@@ -1085,11 +2971,17 @@ def parse_options(argv):
     if args.min_var_len < 0:
         err("Minimum var length must be greater than 0!")
     else:
-        config['min_var_len'] = args.min_var_len
+        config['min_var_length'] = args.min_var_len
 
     if args.reserved:
-        for r in args.reserved:
-            config['custom_reserved_words'].append(r)
+        config['custom_reserved_words'] = config['custom_reserved_words'] + args.reserved
+
+    for path in args.reserved_files or ():
+        try:
+            config['custom_reserved_words'] = config['custom_reserved_words'] + sorted(loadReservedWords(path))
+        except OSError as e:
+            err('Could not read reserved words from %s: %s' % (path, e))
+            return False
 
     return True
 
@@ -1103,6 +2995,23 @@ def main(argv):
     v: %(versionNum)s
 ''' % {'versionNum' : VERSION })
 
+    if config['serve']:
+        return serve(config['serve'], config['jobs'], config['queue_size'])
+
+    if config['output_dir']:
+        (inputs, missing) = collectInputs(config['inputs'], config['manifest'])
+        if not inputs and not missing:
+            err('No input files found!')
+            return False
+        result = runBatch(inputs, config['output_dir'], config['jobs'], config['summary'], missing)
+        if config['cache'] and config['cache_stats']:
+            reportCacheStats(ResultCache(config['cache']))
+        return result
+
+    if not config['file']:
+        reportCacheStats(ResultCache(config['cache']))
+        return True
+
     ok('Input file:\t\t%s' % config['file'])
     if config['output']:
         ok('Output file:\t%s' % config['output'])
@@ -1113,20 +3022,43 @@ def main(argv):
     with open(config['file'], 'r') as f:
         contents = f.read()
 
-    contents = classifyFileAndExtractContents(contents)
-
     ok('Input file length: %d' % len(contents))
 
     obfuscator = ScriptObfuscator(
         config['normalize_only'], \
         config['custom_reserved_words'], \
         config['garbage_perc'], \
-        config['min_var_length'])
-    obfuscated = obfuscator.obfuscate(contents)
-
-    if obfuscated:
-        ok('Obfuscated file length: %d' % len(obfuscated))
-        if not config['output']:
+        config['min_var_length'], \
+        config['jobs'] or 1, \
+        config['seed'], \
+        PassProfiler(config['cprofile']) if config['profile'] else None, \
+        config['passes'], \
+        config['debug'])
+
+    cache = ResultCache(config['cache'], config['cache_size'] * 1024 * 1024) if config['cache'] else None
+    if config['output'] and (not cache or config['seed'] is None):
+        # Written straight into the output file, never held whole in memory.
+        with open(config['output'], 'w') as f:
+            length = obfuscateContents(obfuscator, contents, f)
+        (obfuscated, cached) = (None, False)
+    else:
+        (obfuscated, cached) = obfuscateWithCache(obfuscator, contents, cache, config['seed'])
+        length = len(obfuscated)
+
+    if cached:
+        ok('Obfuscated code taken from the cache.')
+    elif obfuscator.profiler:
+        saveProfile(obfuscator.profiler, config['output'])
+    if cache:
+        cache.flush()
+        if config['cache_stats']:
+            reportCacheStats(cache)
+
+    if length:
+        ok('Obfuscated file length: %d' % length)
+        if obfuscated is None:
+            ok('Obfuscated code has been written to:\n\t\t%s\n' % config['output'])
+        elif not config['output']:
             out('\n\n')
             ok('-' * 80 )
 
@@ -1141,5 +3073,7 @@ def main(argv):
     else:
         return False
 
+    return True
+
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(0 if main(sys.argv) else 1)